@@ -0,0 +1,132 @@
+# admission.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Admission control for service checks. Caps the number of checks in flight in a
+#          process at max_in_flight, orders due checks by how late they are so the most
+#          overdue run first when there is not enough room for all of them, and keeps the
+#          lag and queue depth metrics that show saturation before checks are deferred
+
+import metrics
+import threading
+
+max_in_flight = 500 # checks allowed to run at once in this process
+retry_delay = 5 # seconds before the deadline scheduler retries a deferred check
+
+in_flight = 0
+capacity_changed = threading.Condition()
+
+# metrics
+admitted = 0
+deferred_capacity = 0 # due checks left for a later poll because max_in_flight was reached
+deferred_no_workers = 0 # due checks the worker dispatcher had no workers for
+deferred_backpressure = 0 # due checks the executor processes had no room for
+last_backlog = 0 # checks deferred by the most recent dispatch
+last_lag_max = 0.0 # seconds the most overdue check of the most recent dispatch was late
+last_lag_avg = 0.0
+
+lag_metric = metrics.Histogram('pypatrol_scheduling_lag_seconds', 'Seconds between a check becoming due and its dispatch',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+in_flight_metric = metrics.Gauge('pypatrol_checks_in_flight', 'Service checks currently running in this process', function=lambda: in_flight)
+backlog_metric = metrics.Gauge('pypatrol_check_backlog', 'Due checks deferred by the most recent dispatch', function=lambda: last_backlog)
+admitted_metric = metrics.Counter('pypatrol_checks_admitted_total', 'Service checks dispatched', function=lambda: admitted)
+deferred_metric = metrics.Counter('pypatrol_checks_deferred_total', 'Due checks deferred to a later dispatch by reason', ('reason',),
+    function=lambda: { ('capacity',): deferred_capacity, ('no_workers',): deferred_no_workers, ('backpressure',): deferred_backpressure })
+
+# prioritize()
+#   Purpose: Order due checks most overdue first and split them into the checks that fit in
+#            the free capacity and the checks that have to wait
+#   Params:
+#     - tasks: array of due service rows
+#     - lags: array of seconds each task is overdue, as computed by the database (or from the
+#             database's due times) so that the server clock does not matter
+#   Returns: tuple of (array of (task, lag) admitted, array of task deferred)
+def prioritize(tasks, lags):
+    global deferred_capacity
+    ordered = sorted(zip(tasks, lags), key=lambda e: e[1], reverse=True)
+    room = max(max_in_flight - in_flight, 0)
+    deferred = [e[0] for e in ordered[room:]]
+    deferred_capacity += len(deferred)
+    return (ordered[:room], deferred)
+
+# record()
+#   Purpose: Update the dispatch metrics after a batch of checks has been handed out
+#   Params:
+#     - lags: array of seconds each dispatched check was overdue
+#     - no_workers: number of checks deferred because no workers were available
+#     - backpressure: number of checks deferred because the executors were full
+#     - backlog: total number of checks deferred by this dispatch
+#   Returns: (none)
+def record(lags, no_workers, backpressure, backlog):
+    global admitted, deferred_no_workers, deferred_backpressure, last_backlog, last_lag_max, last_lag_avg
+    admitted += len(lags)
+    for l in lags:
+        lag_metric.observe(max(l, 0.0))
+    deferred_no_workers += no_workers
+    deferred_backpressure += backpressure
+    last_backlog = backlog
+    if len(lags) > 0:
+        last_lag_max = max(lags)
+        last_lag_avg = sum(lags) / len(lags)
+    if backlog > 0:
+        print("admission.py: record - deferred %s checks (%s in flight, %s without workers, %s executor backpressure)" \
+            % (backlog, in_flight, no_workers, backpressure))
+
+# acquire()
+#   Purpose: Count a check as started
+#   Params: (none)
+#   Returns: (none)
+def acquire():
+    global in_flight
+    with capacity_changed:
+        in_flight += 1
+
+# release()
+#   Purpose: Count a check as finished and wake anybody waiting for capacity
+#   Params: (none)
+#   Returns: (none)
+def release():
+    global in_flight
+    with capacity_changed:
+        in_flight -= 1
+        capacity_changed.notify_all()
+
+# wait_for_capacity()
+#   Purpose: Block until fewer than max_in_flight checks are running
+#   Params: (none)
+#   Returns: (none)
+def wait_for_capacity():
+    with capacity_changed:
+        while (in_flight >= max_in_flight):
+            capacity_changed.wait()
+
+# configure()
+#   Purpose: Apply the admission settings from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global max_in_flight, retry_delay
+    max_in_flight = int(config['tasks'].get('max_in_flight', '500'))
+    retry_delay = float(config['tasks'].get('retry_delay', '5'))
+    with capacity_changed:
+        capacity_changed.notify_all()
+
+# stats()
+#   Purpose: Snapshot of the admission metrics
+#   Params: (none)
+#   Returns: dictionary of admission metrics
+def stats():
+    return {
+        'in_flight': in_flight,
+        'max_in_flight': max_in_flight,
+        'admitted': admitted,
+        'deferred_capacity': deferred_capacity,
+        'deferred_no_workers': deferred_no_workers,
+        'deferred_backpressure': deferred_backpressure,
+        'backlog': last_backlog,
+        'lag_max': last_lag_max,
+        'lag_avg': last_lag_avg
+    }
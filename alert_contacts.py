@@ -0,0 +1,101 @@
+# alert_contacts.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: In-process cache of the alert_contact table keyed by user_id. The whole table is
+#          loaded in bulk at startup; a user's contacts are re-read after contact_cache_ttl
+#          seconds or when invalidated, so alerting normally costs no database round trips
+
+from collections import namedtuple
+import db
+import psycopg2, threading, time
+
+# AlertContact - one row of the alert_contact table
+AlertContact = namedtuple('AlertContact', ['id', 'user_id', 'alert_type', 'value'])
+
+# cache entries: user id -> (fetch time, array of AlertContact)
+cache = {}
+cache_lock = threading.Lock()
+ttl = 300 # seconds before a user's contacts are re-read
+
+# load_all()
+#   Purpose: Replace the cache with every row of the alert_contact table
+#   Params: (none)
+#   Returns: (none)
+def load_all():
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, user_id, alert_type, value FROM alert_contact")
+            rows = cur.fetchall()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+    now = time.monotonic()
+    loaded = {}
+    for row in rows:
+        loaded.setdefault(row[1], (now, []))[1].append(AlertContact(*row))
+    with cache_lock:
+        cache.clear()
+        cache.update(loaded)
+    print("alert_contacts.py: load_all - loaded %s alert contacts" % len(rows))
+
+# load_user()
+#   Purpose: Re-read the contacts of a single user
+#   Params:
+#     - user_id: id of the user
+#   Returns: array of AlertContact, or None if the database could not be reached
+def load_user(user_id):
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, user_id, alert_type, value FROM alert_contact WHERE user_id = %s", (user_id,))
+            rows = cur.fetchall()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return None
+    contacts = [AlertContact(*row) for row in rows]
+    with cache_lock:
+        cache[user_id] = (time.monotonic(), contacts)
+    return contacts
+
+# get()
+#   Purpose: Return every alert contact of a user
+#   Params:
+#     - user_id: id of the user
+#   Returns: array of AlertContact (empty if the user has none)
+def get(user_id):
+    with cache_lock:
+        entry = cache.get(user_id)
+    if entry is not None and time.monotonic() - entry[0] <= ttl:
+        return entry[1]
+    contacts = load_user(user_id)
+    if contacts is None:
+        # database unavailable, fall back to the expired entry rather than dropping the alert
+        return entry[1] if entry is not None else []
+    return contacts
+
+# invalidate()
+#   Purpose: Drop cached contacts so they are re-read on next use
+#   Params:
+#     - user_id: id of the user, or None to clear the whole cache
+#   Returns: (none)
+def invalidate(user_id=None):
+    with cache_lock:
+        if user_id is None:
+            cache.clear()
+        else:
+            cache.pop(user_id, None)
+
+# configure()
+#   Purpose: Apply the contact cache settings from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global ttl
+    ttl = int(config['mail'].get('contact_cache_ttl', '300'))
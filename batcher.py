@@ -0,0 +1,205 @@
+# batcher.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Batched dispatch of service checks to pyPatrol-node workers. Checks sent to the
+#          same node within batch_window seconds are collected and posted to the node's /batch
+#          endpoint as one NDJSON request ({"id": n, "endpoint": path, "data": {...}} per line);
+#          the node streams back one {"id": n, "result": {...}} line per check as it finishes,
+#          so a tick costs one request per node instead of one per (service, worker) pair.
+#          Each node has at most max_streams batches streaming at a time (a stream lasts as
+#          long as its slowest check), further checks collect until a stream finishes. Nodes
+#          that do not implement /batch get one request per check
+
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import json, threading, time, requests
+
+enabled = False
+batch_window = 0.02 # seconds checks for the same node are collected before sending
+max_batch = 500 # checks per batch request
+max_streams = 4 # batch requests open at once per node
+http_timeout = 20 # seconds without data from the node (requests applies it per socket read, not to the whole stream)
+
+pending = {} # node uri -> array of (endpoint, data, callback)
+unsupported = set() # node uris that answered /batch with 404
+streaming = {} # node uri -> number of batch requests in flight
+lock = threading.Lock()
+wakeup = threading.Event()
+senders = None # ThreadPoolExecutor running the batch requests
+started = False
+next_id = 0
+
+batches_metric = metrics.Counter('pypatrol_node_batches_total', 'Batched check requests sent to pyPatrol-node workers')
+batch_size_metric = metrics.Histogram('pypatrol_node_batch_size', 'Checks per batched request',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+# submit()
+#   Purpose: Queue a check for the next batch to a node, never blocks
+#   Params:
+#     - node_uri: base uri of the pyPatrol-node worker ("http://ip:port")
+#     - endpoint: check endpoint ("/ping", "/http_response", ...)
+#     - data: service check post data
+#     - callback: called with the result dictionary once the node answers (from a sender thread)
+#   Returns: (none)
+def submit(node_uri, endpoint, data, callback):
+    with lock:
+        items = pending.setdefault(node_uri, [])
+        items.append((endpoint, data, callback))
+        full = len(items) >= max_batch
+    if full:
+        wakeup.set()
+
+# deliver()
+#   Purpose: Hand a result to its check, adding the worker and latency for the check history
+#            and reporting the worker's latency for load balancing
+#   Params:
+#     - node_uri: base uri of the pyPatrol-node worker
+#     - endpoint: check endpoint
+#     - result: result dictionary
+#     - latency: seconds since the request was sent
+#     - error: True if the check could not be delivered
+#     - callback: the check's callback
+#   Returns: (none)
+def deliver(node_uri, endpoint, result, latency, error, callback):
+    import task # task imports this module
+    task.report_worker_result(node_uri + endpoint, latency, error)
+    result['worker'] = node_uri.split('/')[2]
+    result['latency'] = latency
+    try:
+        callback(result)
+    except Exception as e:
+        print(e)
+
+# send_single()
+#   Purpose: Send one check in its own request, for nodes without /batch
+#   Params:
+#     - node_uri: base uri of the pyPatrol-node worker
+#     - item: (endpoint, data, callback)
+#   Returns: (none)
+def send_single(node_uri, item):
+    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    endpoint, data, callback = item
+    start = time.monotonic()
+    try:
+        r = requests.post(node_uri + endpoint, data=json.dumps(data), headers=headers, timeout=http_timeout)
+        result = json.loads(r.text)
+        error = False
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(e)
+        result = { 'status': 'error' }
+        error = True
+    deliver(node_uri, endpoint, result, time.monotonic() - start, error, callback)
+
+# send_batch()
+#   Purpose: Post a batch to a node's /batch endpoint and deliver the streamed results as
+#            they arrive, then let the flusher send the next batch for the node
+#   Params:
+#     - node_uri: base uri of the pyPatrol-node worker
+#     - items: array of (endpoint, data, callback)
+#   Returns: (none)
+def send_batch(node_uri, items):
+    try:
+        stream_batch(node_uri, items)
+    finally:
+        with lock:
+            streaming[node_uri] -= 1
+            if streaming[node_uri] == 0:
+                del streaming[node_uri]
+        wakeup.set()
+
+# stream_batch()
+#   Purpose: Send a batch over one /batch request. Checks missing from the stream are answered
+#            with an error, a node without /batch gets the checks one request each
+#   Params:
+#     - node_uri: base uri of the pyPatrol-node worker
+#     - items: array of (endpoint, data, callback)
+#   Returns: (none)
+def stream_batch(node_uri, items):
+    global next_id
+    waiting = {}
+    lines = []
+    with lock:
+        for item in items:
+            next_id += 1
+            waiting[next_id] = item
+            lines.append(json.dumps({ 'id': next_id, 'endpoint': item[0], 'data': item[1] }))
+    batches_metric.inc()
+    batch_size_metric.observe(len(items))
+    start = time.monotonic()
+    try:
+        r = requests.post(node_uri + '/batch', data='\n'.join(lines) + '\n', stream=True, timeout=http_timeout,
+            headers={'Content-type': 'application/x-ndjson', 'Accept': 'application/x-ndjson'})
+        if r.status_code == 404:
+            print("batcher.py: send_batch - %s has no /batch endpoint, sending one request per check" % node_uri)
+            unsupported.add(node_uri)
+            r.close()
+            for item in items:
+                senders.submit(send_single, node_uri, item)
+            return
+        for line in r.iter_lines():
+            if not line:
+                continue
+            message = json.loads(line)
+            item = waiting.pop(message.get('id'), None)
+            if item is not None:
+                result = message.get('result')
+                # a line without a result is the node failing the check, not a check result
+                deliver(node_uri, item[0], result or { 'status': 'error' }, time.monotonic() - start, not result, item[2])
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(e)
+    for endpoint, data, callback in waiting.values():
+        deliver(node_uri, endpoint, { 'status': 'error' }, time.monotonic() - start, True, callback)
+
+# flush()
+#   Purpose: Flusher thread body, every batch_window seconds (or as soon as a node's batch is
+#            full or one of its streams has finished) sends the collected checks in batches of
+#            up to max_batch to every node with fewer than max_streams batches in flight
+#   Params: (none)
+#   Returns: (none)
+def flush():
+    print("Started node batch flusher thread...")
+    while (True):
+        wakeup.wait(batch_window)
+        wakeup.clear()
+        ready = []
+        with lock:
+            for node_uri in list(pending.keys()):
+                if node_uri in unsupported:
+                    ready.extend((send_single, node_uri, item) for item in pending.pop(node_uri))
+                else:
+                    items = pending.pop(node_uri)
+                    while (len(items) > 0 and streaming.get(node_uri, 0) < max_streams):
+                        streaming[node_uri] = streaming.get(node_uri, 0) + 1
+                        ready.append((send_batch, node_uri, items[:max_batch]))
+                        items = items[max_batch:]
+                    if len(items) > 0:
+                        pending[node_uri] = items
+        for send, node_uri, items in ready:
+            senders.submit(send, node_uri, items)
+
+# init()
+#   Purpose: Apply the batching settings from the pypatrol config and start the flusher
+#            thread on first call when enabled
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def init(config):
+    global enabled, batch_window, max_batch, max_streams, http_timeout, senders, started
+    enabled = config['tasks'].getboolean('node_batching', False)
+    batch_window = float(config['tasks'].get('node_batch_window', '0.02'))
+    max_batch = int(config['tasks'].get('node_batch_size', '500'))
+    max_streams = int(config['tasks'].get('node_batch_streams', '4'))
+    http_timeout = int(config['tasks']['http_timeout'])
+    if not enabled:
+        return
+    with lock:
+        if started:
+            return
+        started = True
+    senders = ThreadPoolExecutor(max_workers=int(config['tasks'].get('node_batch_senders', '32')), thread_name_prefix='node_batch')
+    t = threading.Thread(target=flush, name='node_batch_flusher')
+    t.setDaemon(True)
+    t.start()
@@ -0,0 +1,336 @@
+# bench.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Benchmark / load simulation for the scheduler -> dispatcher -> node pipeline. Seeds
+#          a scratch PostgreSQL database from test.sql scaled up to the requested number of
+#          services, starts fake pyPatrol-node workers (fake_node.py) and an in-process SMTP
+#          sink, runs worker_mgr and task_mgr end to end for a fixed duration and reports
+#          throughput, scheduling lag, check latency, thread/memory peaks and database queries
+#          per check as JSON
+#
+# Usage:   python3 bench.py --services 10000 --nodes 5 --node-latency 0.05 --duration 120 \
+#              --output bench.json
+#          The database user must be allowed to drop/create the benchmark database (test.sql
+#          recreates pypatrol_test) and psql must be on the PATH unless --skip-seed is given
+
+from datetime import datetime, timedelta
+import fake_node, settings
+import argparse, json, os, resource, smtplib, subprocess, tempfile, threading, time
+import psycopg2, psycopg2.extensions
+
+# SQL used to scale test.sql up to the requested number of services. Bench services are
+# spread evenly over one interval so the run starts in steady state
+SEED_SQL = [
+    "INSERT INTO service (user_id, active, type, name, status, status_desc, error_state, interval, " \
+    "last_check_time, status_change_time) " \
+    "SELECT 1, TRUE, (g %% 6) + 1, 'BENCH ' || g, CASE WHEN (g %% 6) + 1 = 4 THEN 'valid' ELSE 'online' END, " \
+    "NULL, FALSE, %(interval)s, NOW() - ((g %% %(interval)s) * interval '1 sec'), NOW() " \
+    "FROM generate_series(1, %(services)s) g",
+    "INSERT INTO ip_port_service (service_id, ip_host, port) " \
+    "SELECT id, CASE WHEN type = 2 THEN '::1' ELSE '127.0.0.1' END, CASE WHEN type IN (5, 6) THEN 53 ELSE NULL END " \
+    "FROM service WHERE type IN (1, 2, 5, 6) AND name LIKE 'BENCH %%'",
+    "INSERT INTO http_service (id, service_id, hostname, redirects, check_string, keywords) " \
+    "SELECT id, id, 'http://127.0.0.1', FALSE, FALSE, NULL FROM service WHERE type = 3 AND name LIKE 'BENCH %%'",
+    "INSERT INTO cert_service (id, service_id, hostname, buffer) " \
+    "SELECT id, id, '127.0.0.1', 14 FROM service WHERE type = 4 AND name LIKE 'BENCH %%'",
+    "ANALYZE"
+]
+
+# CountingCursor class - psycopg2 cursor that counts every statement executed through the pool
+class CountingCursor(psycopg2.extensions.cursor):
+    queries = 0
+    lock = threading.Lock()
+
+    def execute(self, query, vars=None):
+        with CountingCursor.lock:
+            CountingCursor.queries += 1
+        return super().execute(query, vars)
+
+# SinkSMTP class - stands in for smtplib.SMTP_SSL and only counts the messages it is given
+class SinkSMTP():
+    connections = 0
+    messages = 0
+    lock = threading.Lock()
+
+    def __init__(self, host='', port=0, *args, **kwargs):
+        with SinkSMTP.lock:
+            SinkSMTP.connections += 1
+
+    def login(self, user, password):
+        return (235, b'Authentication successful')
+
+    def sendmail(self, from_addr, to_addrs, msg, *args, **kwargs):
+        with SinkSMTP.lock:
+            SinkSMTP.messages += 1
+        return {}
+
+    def send_message(self, msg, *args, **kwargs):
+        return self.sendmail(None, None, msg)
+
+    def noop(self):
+        return (250, b'OK')
+
+    def quit(self):
+        return (221, b'Bye')
+
+    def close(self):
+        pass
+
+# Metrics class - collects the pipeline measurements while the benchmark runs
+class Metrics():
+    def __init__(self, db_clock_offset):
+        self.db_clock_offset = db_clock_offset # database NOW() minus local time
+        self.lock = threading.Lock()
+        self.dispatched = 0
+        self.completed = 0
+        self.polls = 0
+        self.lags = [] # seconds between due time and dispatch
+        self.latencies = [] # seconds between dispatch and consensus
+        self.started = {} # service id -> dispatch time
+        self.peak_threads = threading.active_count()
+        self.peak_rss_kb = 0
+
+    def on_dispatch(self, tasks):
+        now = time.monotonic()
+        db_now = datetime.now() + self.db_clock_offset
+        with self.lock:
+            self.polls += 1
+            self.dispatched += len(tasks)
+            for t in tasks:
+                due = t[9] + timedelta(seconds=t[8])
+                self.lags.append(max((db_now - due).total_seconds(), 0.0))
+                self.started[t[0]] = now
+
+    def on_complete(self, service):
+        now = time.monotonic()
+        with self.lock:
+            self.completed += 1
+            start = self.started.pop(service[0], None)
+            if start is not None:
+                self.latencies.append(now - start)
+
+    def sample(self):
+        while (True):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss_kb = max(self.peak_rss_kb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            time.sleep(0.5)
+
+# percentile()
+#   Purpose: Nearest-rank percentile of an array of numbers
+#   Params:
+#     - values: array of numbers
+#     - p: percentile (0 - 100)
+#   Returns: the percentile, or None for an empty array
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+# seed()
+#   Purpose: Recreate the benchmark database from test.sql and scale it up
+#   Params:
+#     - args: parsed command line arguments
+#   Returns: (none)
+def seed(args):
+    env = dict(os.environ, PGPASSWORD=args.db_password)
+    subprocess.check_call([args.psql, '-q', '-v', 'ON_ERROR_STOP=1', '-h', args.db_host, '-p', str(args.db_port),
+        '-U', args.db_user, '-d', 'postgres', '-f', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.sql')],
+        env=env, stdout=subprocess.DEVNULL)
+    conn = psycopg2.connect(host=args.db_host, port=args.db_port, database=args.db_database,
+        user=args.db_user, password=args.db_password)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for sql in SEED_SQL:
+        cur.execute(sql, { 'services': args.services, 'interval': args.interval })
+    cur.close()
+    conn.close()
+    print("bench.py: seed - seeded %s services" % args.services)
+
+# write_config()
+#   Purpose: Write a pypatrol config for the benchmark run and point settings at it
+#   Params:
+#     - args: parsed command line arguments
+#   Returns: path of the config file
+def write_config(args):
+    fd, path = tempfile.mkstemp(prefix='pypatrol-bench-', suffix='.conf')
+    with os.fdopen(fd, 'w') as f:
+        f.write("[tasks]\n")
+        f.write("db_poll_interval = %s\n" % args.poll_interval)
+        f.write("http_timeout = %s\n" % args.http_timeout)
+        f.write("scheduler = %s\n" % args.scheduler)
+        f.write("engine = %s\n" % args.engine)
+        f.write("node_batching = %s\n" % ('true' if args.node_batching else 'false'))
+        f.write("max_concurrent_checks = %s\n" % args.max_concurrent_checks)
+        f.write("\n[workers]\n")
+        f.write("secrets = [\"bench\"]\n")
+        f.write("endpoint_port = %s\n" % args.endpoint_port)
+        f.write("dispatcher_host = 127.0.0.1\n")
+        f.write("dispatcher_port = %s\n" % args.dispatcher_port)
+        f.write("inactivity_interval = 30\n")
+        f.write("selection = %s\n" % args.selection)
+        f.write("\n[database]\n")
+        f.write("host = %s\nport = %s\ndatabase = %s\nuser = %s\npassword = %s\n" % (args.db_host,
+            args.db_port, args.db_database, args.db_user, args.db_password))
+        f.write("pool_min_size = 0\npool_max_size = %s\n" % args.pool_max_size)
+        f.write("\n[mail]\n")
+        f.write("smtp_server = 127.0.0.1\nsmtp_port = 465\nsmtp_user = bench@localhost\nsmtp_password = bench\n")
+        f.write("digest_window = %s\n" % args.digest_window)
+    settings.path = path
+    return path
+
+# run()
+#   Purpose: Run the pipeline against the fake nodes and collect the results
+#   Params:
+#     - args: parsed command line arguments
+#   Returns: dictionary of benchmark results
+def run(args):
+    import admission, db, notifier, task, task_mgr, worker_mgr
+
+    config = settings.load()
+    smtplib.SMTP_SSL = SinkSMTP
+
+    # count every statement that goes through the connection pool
+    db.init(config)
+    db.pool.db_params['cursor_factory'] = CountingCursor
+
+    conn = psycopg2.connect(**{ k: v for k, v in db.pool.db_params.items() if k != 'cursor_factory' })
+    cur = conn.cursor()
+    cur.execute("SELECT NOW()::timestamp")
+    metrics = Metrics(cur.fetchone()[0] - datetime.now())
+    conn.close()
+
+    # instrument the pipeline's entry and exit points
+    process_tasks = task_mgr.process_tasks
+    def instrumented_process_tasks(tasks, lags):
+        deferred = process_tasks(tasks, lags)
+        skipped = set(t[0] for t in deferred)
+        metrics.on_dispatch([t for t in tasks if t[0] not in skipped])
+        return deferred
+    task_mgr.process_tasks = instrumented_process_tasks
+    check_for_status_change = task.check_for_status_change
+    def instrumented_check_for_status_change(service, results, learn=True):
+        metrics.on_complete(service)
+        check_for_status_change(service, results, learn)
+    task.check_for_status_change = instrumented_check_for_status_change
+
+    s = threading.Thread(target=metrics.sample, name='bench_sampler')
+    s.setDaemon(True)
+    s.start()
+
+    # worker manager first, then the fake nodes register with it
+    wm = threading.Thread(target=worker_mgr.main, name='worker_mgr')
+    wm.setDaemon(True)
+    wm.start()
+    time.sleep(1)
+    nodes = []
+    for i in range(args.nodes):
+        node = fake_node.FakeNode('bench-node-%s' % i, args.node_latency, args.node_jitter, args.failure_rate)
+        node.start('127.0.0.1', args.endpoint_port, 'bench', 10)
+        nodes.append(node)
+    deadline = time.monotonic() + 30
+    while worker_mgr.registry.count('ipv4') < min(args.nodes, 3) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    print("bench.py: run - %s fake nodes registered" % worker_mgr.registry.count('ipv4'))
+
+    queries_before = CountingCursor.queries
+    start = time.monotonic()
+    tm = threading.Thread(target=task_mgr.main, name='task_mgr')
+    tm.setDaemon(True)
+    tm.start()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - start
+
+    with metrics.lock:
+        completed = metrics.completed
+        queries = CountingCursor.queries - queries_before
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'parameters': {
+                'services': args.services,
+                'interval': args.interval,
+                'nodes': args.nodes,
+                'node_latency': args.node_latency,
+                'node_jitter': args.node_jitter,
+                'failure_rate': args.failure_rate,
+                'scheduler': args.scheduler,
+                'engine': args.engine,
+                'node_batching': args.node_batching,
+                'selection': args.selection,
+                'duration': args.duration
+            },
+            'polls': metrics.polls,
+            'checks_dispatched': metrics.dispatched,
+            'checks_completed': completed,
+            'throughput_checks_per_sec': completed / elapsed,
+            'scheduling_lag_p50': percentile(metrics.lags, 50),
+            'scheduling_lag_p99': percentile(metrics.lags, 99),
+            'scheduling_lag_max': max(metrics.lags) if len(metrics.lags) > 0 else None,
+            'check_latency_p50': percentile(metrics.latencies, 50),
+            'check_latency_p99': percentile(metrics.latencies, 99),
+            'peak_threads': metrics.peak_threads,
+            'peak_rss_kb': metrics.peak_rss_kb,
+            'db_queries': queries,
+            'db_queries_per_check': queries / completed if completed > 0 else None,
+            'db_pool': db.stats(),
+            'admission': admission.stats(),
+            'node_requests': sum(n.requests for n in nodes),
+            'node_batched_checks': sum(n.batched_checks for n in nodes),
+            'notifier': notifier.stats(),
+            'smtp_connections': SinkSMTP.connections,
+            'smtp_messages': SinkSMTP.messages
+        }
+
+# main()
+#   Purpose: Parse the command line, seed the database, run the benchmark and emit results
+#   Params: (none)
+#   Returns: (none)
+def main():
+    parser = argparse.ArgumentParser(description='pyPatrol-server pipeline benchmark')
+    parser.add_argument('--services', type=int, default=1000, help='number of services to seed (1k - 1M)')
+    parser.add_argument('--interval', type=int, default=60, help='check interval of the seeded services')
+    parser.add_argument('--nodes', type=int, default=3, help='number of fake pyPatrol-node workers')
+    parser.add_argument('--node-latency', type=float, default=0.0, help='fake node response delay (s)')
+    parser.add_argument('--node-jitter', type=float, default=0.0, help='extra random fake node delay (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of wrong check results')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run the pipeline')
+    parser.add_argument('--scheduler', default='poll', choices=['poll', 'deadline'])
+    parser.add_argument('--engine', default='thread', choices=['thread', 'asyncio'])
+    parser.add_argument('--node-batching', action='store_true', help='send checks to the fake nodes through /batch')
+    parser.add_argument('--selection', default='uniform')
+    parser.add_argument('--poll-interval', type=int, default=5)
+    parser.add_argument('--http-timeout', type=int, default=20)
+    parser.add_argument('--max-concurrent-checks', type=int, default=500)
+    parser.add_argument('--digest-window', type=float, default=5)
+    parser.add_argument('--pool-max-size', type=int, default=10)
+    parser.add_argument('--endpoint-port', type=int, default=22346)
+    parser.add_argument('--dispatcher-port', type=int, default=22347)
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db-database', default='pypatrol_test')
+    parser.add_argument('--db-user', default='pypatrol')
+    parser.add_argument('--db-password', default='onaroll')
+    parser.add_argument('--psql', default='psql', help='psql binary used to load test.sql')
+    parser.add_argument('--skip-seed', action='store_true', help='reuse the existing benchmark database')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        seed(args)
+    path = write_config(args)
+    try:
+        results = run(args)
+    finally:
+        os.remove(path)
+
+    output = json.dumps(results, indent=2, default=str)
+    print(output)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# cluster.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Lets several pyPatrol-server instances share the service table. Every instance
+#          heartbeats into the scheduler_instance table; the instances whose heartbeat lease
+#          has not expired split a fixed number of buckets (service.id % BUCKETS) between them
+#          with rendezvous hashing, so ownership rebalances by itself when an instance joins or
+#          dies and only the buckets of that instance move
+
+import db
+import psycopg2, hashlib, os, socket, threading, time, atexit
+
+BUCKETS = 1024 # keep in sync with the service_bucket_idx expression index in test.sql
+
+enabled = False
+instance_id = None
+heartbeat_interval = 5 # seconds between heartbeats
+lease_timeout = 15 # seconds without a heartbeat before an instance's buckets are reassigned
+claim_tolerance = 1 # seconds a service may be claimed before it is due (scheduler clock skew)
+
+members = [] # ids of the live instances, sorted
+buckets = [] # buckets owned by this instance
+version = 0 # incremented every time the owned buckets change
+lock = threading.Lock()
+
+# score()
+#   Purpose: Rendezvous hash weight of an instance for a bucket
+#   Params:
+#     - member: instance id
+#     - bucket: bucket number
+#   Returns: integer, the live instance with the highest score owns the bucket
+def score(member, bucket):
+    return int.from_bytes(hashlib.md5((member + ":" + str(bucket)).encode('utf-8')).digest()[:8], 'big')
+
+# assign()
+#   Purpose: Compute the buckets owned by an instance for a given set of live instances
+#   Params:
+#     - live: array of live instance ids
+#     - member: instance id to compute the buckets of
+#   Returns: array of bucket numbers
+def assign(live, member):
+    return [b for b in range(BUCKETS) if max(live, key=lambda m: score(m, b)) == member]
+
+# heartbeat()
+#   Purpose: Renew this instance's lease, expire dead instances and recompute ownership
+#   Params: (none)
+#   Returns: (none)
+def heartbeat():
+    global members, buckets, version
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO scheduler_instance (id, heartbeat) VALUES (%s, NOW()) " \
+                "ON CONFLICT (id) DO UPDATE SET heartbeat = NOW()", (instance_id,))
+            cur.execute("DELETE FROM scheduler_instance WHERE heartbeat < NOW() - (%s * interval '1 sec')", (lease_timeout,))
+            cur.execute("SELECT id FROM scheduler_instance ORDER BY id")
+            live = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+    if live == members:
+        return
+    owned = assign(live, instance_id)
+    with lock:
+        members = live
+        buckets = owned
+        version += 1
+    print("cluster.py: heartbeat - %s live instances, %s owns %s of %s buckets" % (len(live), instance_id, len(owned), BUCKETS))
+
+# run()
+#   Purpose: Heartbeat thread body
+#   Params: (none)
+#   Returns: (none)
+def run():
+    print("Started cluster heartbeat thread...")
+    while (True):
+        time.sleep(heartbeat_interval)
+        heartbeat()
+
+# leave()
+#   Purpose: Give up this instance's lease on shutdown so its buckets move immediately
+#   Params: (none)
+#   Returns: (none)
+def leave():
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM scheduler_instance WHERE id = %s", (instance_id,))
+            conn.commit()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+# owned()
+#   Purpose: Snapshot of the buckets owned by this instance
+#   Params: (none)
+#   Returns: tuple of (array of bucket numbers, ownership version)
+def owned():
+    with lock:
+        return (buckets, version)
+
+# init()
+#   Purpose: Read the [cluster] settings and, when enabled, join the cluster and start the
+#            heartbeat thread
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def init(config):
+    global enabled, instance_id, heartbeat_interval, lease_timeout, claim_tolerance
+    if not config.has_section('cluster') or not config['cluster'].getboolean('enabled', False):
+        return
+    enabled = True
+    instance_id = config['cluster'].get('instance_id', socket.gethostname() + "-" + str(os.getpid()))
+    heartbeat_interval = int(config['cluster'].get('heartbeat_interval', '5'))
+    lease_timeout = int(config['cluster'].get('lease_timeout', '15'))
+    claim_tolerance = float(config['cluster'].get('claim_tolerance', '1'))
+    # join synchronously so the first poll already knows which buckets it owns
+    heartbeat()
+    atexit.register(leave)
+    t = threading.Thread(target=run, name='cluster_heartbeat')
+    t.setDaemon(True)
+    t.start()
@@ -0,0 +1,91 @@
+# coalesce.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Coalesces identical probes across services. Services that check the same target
+#          (same endpoint and post data, e.g. thousands of users pinging 8.8.8.8) share one
+#          fan-out: the first check of a target leads, checks of the same target arriving while
+#          it runs wait for its results, and the results are reused for probe_cache_ttl
+#          seconds afterwards
+
+import metrics
+import json, threading, time
+
+enabled = False
+ttl = 10.0 # seconds finished probe results are reused
+
+cache = {} # probe key -> (monotonic time finished, results)
+inflight = {} # probe key -> array of service rows waiting for the leader's results
+lock = threading.Lock()
+last_purge = 0.0
+
+coalesced_metric = metrics.Counter('pypatrol_probes_coalesced_total', 'Checks answered by another service\'s probe', ('source',))
+
+# key()
+#   Purpose: Identity of a probe, equal for services checking the same target the same way with
+#            the same number of workers (so a service with a larger fanout never gets the
+#            smaller result set of another service's probe)
+#   Params:
+#     - service_url: endpoint url suffix of the check
+#     - post_data: service check post data
+#     - fanout: number of workers the check is sent to
+#   Returns: string, or None if the probe cannot be coalesced
+def key(service_url, post_data, fanout):
+    if not enabled or post_data is None:
+        return None
+    return str(fanout) + service_url + json.dumps(post_data, sort_keys=True)
+
+# join()
+#   Purpose: Register a check for a probe
+#   Params:
+#     - probe: probe key (key())
+#     - service: service row of the check
+#   Returns: tuple of (role, results). role is 'cached' (results are fresh cached results),
+#            'follower' (a running probe will deliver results, nothing to do) or 'leader'
+#            (run the probe and call finish())
+def join(probe, service):
+    global last_purge
+    now = time.monotonic()
+    with lock:
+        if now - last_purge > ttl:
+            # drop expired results so the cache only holds the last ttl seconds of probes
+            for k in [k for k, v in cache.items() if now - v[0] > ttl]:
+                del cache[k]
+            last_purge = now
+        entry = cache.get(probe)
+        if entry is not None and now - entry[0] <= ttl:
+            coalesced_metric.inc(labels=('cache',))
+            return ('cached', entry[1])
+        waiting = inflight.get(probe)
+        if waiting is not None:
+            waiting.append(service)
+            coalesced_metric.inc(labels=('inflight',))
+            return ('follower', None)
+        inflight[probe] = []
+        return ('leader', None)
+
+# finish()
+#   Purpose: Publish the results of a probe run by a leader
+#   Params:
+#     - probe: probe key
+#     - results: array of worker results of the probe, empty if the probe failed
+#   Returns: array of service rows of the checks that waited for the results
+def finish(probe, results):
+    with lock:
+        followers = inflight.pop(probe, [])
+        # failed probes (no results at all) are not reused
+        if ttl > 0 and any(r is not None for r in results):
+            cache[probe] = (time.monotonic(), results)
+    return followers
+
+# configure()
+#   Purpose: Apply the probe coalescing settings from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global enabled, ttl
+    enabled = config['tasks'].getboolean('probe_coalescing', False)
+    ttl = float(config['tasks'].get('probe_cache_ttl', '10'))
@@ -0,0 +1,182 @@
+# consensus.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Decides the status of a service from any number of worker results. The quorum
+#          policy counts one vote per result, the weighted policy weighs each worker by how
+#          often it agreed with past decisions. A status wins when its share of the votes
+#          exceeds quorum, otherwise the check is an error. Transitions are flap damped: the
+#          new state must be seen on `confirmations` consecutive checks before it is applied.
+#          Checks are evaluated in batches so the shared state is locked once per batch, and
+#          settled() lets a check stop waiting for workers once the outcome can no longer change
+
+import metrics
+import json, threading
+
+policy = 'quorum' # 'quorum' or 'weighted'
+quorum = 0.5 # share of the votes the winning status must exceed (0.5 = majority, 2 of 3)
+confirmations = 1 # consecutive checks that must agree on a new state before it is applied
+reliability_alpha = 0.05 # EWMA weight of the latest agreement in a worker's reliability
+min_weight = 0.1 # floor of a worker's vote in the weighted policy
+fanout = 3 # workers asked per check
+fanout_overrides = {} # service id -> workers asked per check (critical services)
+spare_workers = 1 # extra workers allocated per check for hedged requests
+hedge_delay = 2.0 # seconds without a settled vote before stragglers are hedged, 0 disables
+
+reliability = {} # worker "ip:port" -> EWMA of agreement with the decided status (0.0 - 1.0)
+flapping = {} # service id -> [candidate state, consecutive confirmations so far]
+lock = threading.Lock()
+
+outcome_metric = metrics.Counter('pypatrol_consensus_total', 'Service check consensus outcomes', ('outcome',))
+damped_metric = metrics.Counter('pypatrol_consensus_damped_total', 'State changes held back by flap damping')
+
+# weight()
+#   Purpose: Vote of a worker under the configured policy. Called with the lock held
+#   Params:
+#     - worker: worker "ip:port"
+#   Returns: float
+def weight(worker):
+    if policy == 'weighted':
+        return max(reliability.get(worker, 1.0), min_weight)
+    return 1.0
+
+# count()
+#   Purpose: Sum the votes per status of the results received so far. Called with the lock held
+#   Params:
+#     - results: array of worker result dictionaries (None entries are ignored)
+#   Returns: tuple of (dictionary of status -> votes, total votes)
+def count(results):
+    tally = {}
+    total = 0.0
+    for result in results:
+        if result is None:
+            continue
+        w = weight(result.get('worker'))
+        status = result.get('status', 'error')
+        tally[status] = tally.get(status, 0.0) + w
+        total += w
+    return (tally, total)
+
+# vote()
+#   Purpose: Tally the worker results of one check. Called with the lock held
+#   Params:
+#     - results: array of worker result dictionaries (None entries are ignored)
+#   Returns: tuple of (winning status, outcome: 'unanimous', 'majority' or 'no_quorum')
+def vote(results):
+    tally, total = count(results)
+    if total == 0:
+        return ('error', 'no_quorum')
+    status = max(tally, key=tally.get)
+    if tally[status] <= quorum * total:
+        return ('error', 'no_quorum')
+    return (status, 'unanimous' if len(tally) == 1 else 'majority')
+
+# settled()
+#   Purpose: Determine whether the results received so far already decide the check, i.e. no
+#            combination of the outstanding results could change the winning status
+#   Params:
+#     - results: array of worker result dictionaries received so far (None entries are ignored)
+#     - outstanding: array of worker "ip:port" whose results have not arrived
+#   Returns: True if the check can be evaluated without waiting for the outstanding workers
+def settled(results, outstanding):
+    with lock:
+        tally, total = count(results)
+        pending = sum(weight(w) for w in outstanding)
+    if total == 0:
+        return False
+    return max(tally.values()) > quorum * (total + pending)
+
+# learn()
+#   Purpose: Move the reliability of every worker towards whether it agreed with the decision.
+#            Called with the lock held
+#   Params:
+#     - results: array of worker result dictionaries
+#     - status: decided status
+#   Returns: (none)
+def learn(results, status):
+    for result in results:
+        if result is None or 'worker' not in result:
+            continue
+        agreed = 1.0 if result.get('status') == status else 0.0
+        previous = reliability.get(result['worker'], 1.0)
+        reliability[result['worker']] = (1 - reliability_alpha) * previous + reliability_alpha * agreed
+
+# damp()
+#   Purpose: Apply flap damping to a check's state. Called with the lock held
+#   Params:
+#     - service_id: id of the service
+#     - current: current state of the service ('error' while in error state, else its status)
+#     - state: state decided by this check
+#   Returns: the state to act on (current while a change is not confirmed yet)
+def damp(service_id, current, state):
+    if state == current:
+        flapping.pop(service_id, None)
+        return state
+    if confirmations <= 1:
+        return state
+    entry = flapping.get(service_id)
+    if entry is None or entry[0] != state:
+        entry = [state, 0]
+        flapping[service_id] = entry
+    entry[1] += 1
+    if entry[1] < confirmations:
+        damped_metric.inc()
+        return current
+    del flapping[service_id]
+    return state
+
+# evaluate()
+#   Purpose: Decide the status of a batch of checks
+#   Params:
+#     - batch: array of (service, results, learn), service being the service row, results the
+#              array of worker result dictionaries of its check and learn False when the
+#              results were already learned from (a probe shared by several services)
+#   Returns: array of (service, results, status, state), status being the consensus status
+#            of the check ('error' if the workers did not reach a quorum) and state the status
+#            to act on after flap damping
+def evaluate(batch):
+    decided = []
+    outcomes = {}
+    with lock:
+        for service, results, learned in batch:
+            status, outcome = vote(results)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome != 'no_quorum' and learned:
+                learn(results, status)
+            # an unconfirmed change keeps the current state, which the caller sees as no change
+            current = 'error' if service[7] else service[5]
+            decided.append((service, results, status, damp(service[0], current, status)))
+    for outcome, count in outcomes.items():
+        outcome_metric.inc(count, (outcome,))
+    return decided
+
+# workers_for()
+#   Purpose: Number of workers a service's check is sent to
+#   Params:
+#     - service: service row
+#   Returns: integer
+def workers_for(service):
+    return fanout_overrides.get(service[0], fanout)
+
+# configure()
+#   Purpose: Apply the [consensus] settings from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global policy, quorum, confirmations, reliability_alpha, min_weight, fanout, fanout_overrides
+    global spare_workers, hedge_delay
+    if not config.has_section('consensus'):
+        return
+    section = config['consensus']
+    policy = section.get('policy', 'quorum')
+    quorum = float(section.get('quorum', '0.5'))
+    confirmations = int(section.get('confirmations', '1'))
+    reliability_alpha = float(section.get('reliability_alpha', '0.05'))
+    min_weight = float(section.get('min_weight', '0.1'))
+    fanout = int(section.get('fanout', '3'))
+    fanout_overrides = dict((int(k), int(v)) for k, v in json.loads(section.get('fanout_overrides', '{}')).items())
+    spare_workers = int(section.get('spare_workers', '1'))
+    hedge_delay = float(section.get('hedge_delay', '2'))
@@ -0,0 +1,364 @@
+# db.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Process-wide PostgreSQL connection pool shared by the task manager, the scheduler
+#          and the task threads. Connections are checked out per thread (nested checkouts on
+#          the same thread reuse the same connection), health checked when they have been
+#          idle for a while, and the pool keeps wait time, in-use and checkout latency metrics.
+#          Also holds the write-behind buffer that batches service status/error_state writes
+
+from contextlib import contextmanager
+import metrics
+import psycopg2, psycopg2.extras, threading, time
+
+# ConnectionPool class - a bounded pool of psycopg2 connections
+class ConnectionPool():
+    def __init__(self, db_params, min_size, max_size, health_check_interval):
+        self.db_params = db_params # keyword arguments for psycopg2.connect()
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval # idle seconds before a connection is re-validated
+        self.idle = [] # (connection, time returned to the pool)
+        self.size = 0 # number of open connections, idle or in use
+        self.cond = threading.Condition()
+        self.local = threading.local() # per-thread checked out connection and nesting depth
+
+        # metrics
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0 # total seconds spent waiting for a free connection
+        self.max_wait_time = 0.0
+        self.checkout_time = 0.0 # total seconds spent in checkout (wait + connect + health check)
+        self.max_checkout_time = 0.0
+        self.discarded = 0 # connections dropped after failing a health check or an error
+
+        for i in range(min_size):
+            self.idle.append((psycopg2.connect(**self.db_params), time.monotonic()))
+            self.size += 1
+
+    # healthy()
+    #   Purpose: Determine whether an idle connection is still usable
+    #   Params:
+    #     - conn: psycopg2 connection
+    #     - idle_since: monotonic time the connection was returned to the pool
+    #   Returns: True if the connection can be handed out
+    def healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except (Exception, psycopg2.DatabaseError):
+            return False
+
+    # discard()
+    #   Purpose: Close a connection and free its slot in the pool
+    #   Params:
+    #     - conn: psycopg2 connection
+    #   Returns: (none)
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.size -= 1
+            self.discarded += 1
+            self.cond.notify()
+
+    # acquire()
+    #   Purpose: Take a connection from the pool, opening a new one if below max_size and
+    #            blocking until one is returned otherwise
+    #   Params: (none)
+    #   Returns: a psycopg2 connection
+    def acquire(self):
+        start = time.monotonic()
+        waited = 0.0
+        while (True):
+            conn = None
+            idle_since = None
+            with self.cond:
+                if len(self.idle) == 0 and self.size >= self.max_size:
+                    self.waits += 1
+                    wait_start = time.monotonic()
+                    while len(self.idle) == 0 and self.size >= self.max_size:
+                        self.cond.wait()
+                    waited += time.monotonic() - wait_start
+                if len(self.idle) > 0:
+                    conn, idle_since = self.idle.pop()
+                else:
+                    self.size += 1 # reserve a slot, connect outside of the lock
+            if conn is None:
+                try:
+                    conn = psycopg2.connect(**self.db_params)
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+                    raise
+            elif not self.healthy(conn, idle_since):
+                self.discard(conn)
+                continue
+            break
+
+        elapsed = time.monotonic() - start
+        with self.cond:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return conn
+
+    # release()
+    #   Purpose: Return a connection to the pool, rolling back anything left uncommitted and
+    #            dropping it if it has been closed or broken
+    #   Params:
+    #     - conn: psycopg2 connection
+    #   Returns: (none)
+    def release(self, conn):
+        with self.cond:
+            self.in_use -= 1
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except (Exception, psycopg2.DatabaseError):
+            pass
+        if conn.closed:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    # connection()
+    #   Purpose: Context manager that checks out a connection for the current thread. Nested
+    #            checkouts on the same thread share the outer connection
+    #   Params: (none)
+    #   Returns: a psycopg2 connection (via the with statement)
+    @contextmanager
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.depth += 1
+            try:
+                yield conn
+            finally:
+                self.local.depth -= 1
+            return
+
+        conn = self.acquire()
+        self.local.conn = conn
+        self.local.depth = 1
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection itself is likely broken, do not hand it out again
+            conn.close()
+            raise
+        finally:
+            self.local.conn = None
+            self.local.depth = 0
+            self.release(conn)
+
+    # dedicated()
+    #   Purpose: Context manager that checks out a connection of its own, not shared with
+    #            nested checkouts on the thread, e.g. to keep a server-side cursor open while
+    #            the rows it returns are written through connection()
+    #   Params: (none)
+    #   Returns: a psycopg2 connection (via the with statement)
+    @contextmanager
+    def dedicated(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            conn.close()
+            raise
+        finally:
+            self.release(conn)
+
+    # stats()
+    #   Purpose: Snapshot of the pool metrics
+    #   Params: (none)
+    #   Returns: dictionary of pool metrics
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time_total': self.wait_time,
+                'wait_time_max': self.max_wait_time,
+                'checkout_latency_avg': self.checkout_time / self.checkouts if self.checkouts > 0 else 0.0,
+                'checkout_latency_max': self.max_checkout_time,
+                'discarded': self.discarded
+            }
+
+# ServiceWriteBuffer class - write-behind buffer for service status and error_state transitions.
+#   Pending writes are coalesced per service id and flushed as a single bulk UPDATE
+class ServiceWriteBuffer():
+    def __init__(self, pool, flush_interval):
+        self.pool = pool
+        self.flush_interval = flush_interval # seconds between flushes
+        self.pending = {} # service id -> [status or None, error_state]
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+
+    # queue()
+    #   Purpose: Record a service transition to be written on the next flush. A later write for
+    #            the same service replaces the error_state of an earlier one and keeps its status
+    #   Params:
+    #     - service_id: id of the service row
+    #     - status: new status (sets status_change_time and clears error_state), or None
+    #     - error_state: new error_state
+    #   Returns: (none)
+    def queue(self, service_id, status, error_state):
+        with self.lock:
+            entry = self.pending.get(service_id)
+            if entry is None:
+                self.pending[service_id] = [status, error_state]
+            else:
+                if status is not None:
+                    entry[0] = status
+                entry[1] = error_state
+
+    # flush()
+    #   Purpose: Write every pending transition in one statement
+    #   Params: (none)
+    #   Returns: (none)
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            pending = self.pending
+            self.pending = {}
+        rows = [(service_id, entry[0], entry[1]) for service_id, entry in pending.items()]
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                psycopg2.extras.execute_values(cur,
+                    "UPDATE service AS s SET status = COALESCE(v.status, s.status), error_state = v.error_state, " \
+                    "status_change_time = CASE WHEN v.status IS NULL THEN s.status_change_time ELSE NOW() END " \
+                    "FROM (VALUES %s) AS v(id, status, error_state) WHERE s.id = v.id",
+                    rows, template="(%s::int, %s::text, %s::boolean)", page_size=1000)
+                conn.commit()
+                cur.close()
+            self.flushes += 1
+            self.rows_written += len(rows)
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+            # put the writes back, merged under any newer transition queued in the meantime so
+            #   that a status change is not lost behind a later error_state only write
+            with self.lock:
+                for service_id, entry in pending.items():
+                    newer = self.pending.get(service_id)
+                    if newer is None:
+                        self.pending[service_id] = entry
+                    elif newer[0] is None:
+                        newer[0] = entry[0]
+
+    # run()
+    #   Purpose: Flush the buffer every flush_interval seconds
+    #   Params: (none)
+    #   Returns: (none)
+    def run(self):
+        print("Started service write buffer thread...")
+        while (True):
+            time.sleep(self.flush_interval)
+            self.flush()
+
+# process-wide pool and write buffer, created by init()
+pool = None
+writer = None
+pool_lock = threading.Lock()
+
+# init()
+#   Purpose: Create the process-wide connection pool from the [database] section of the
+#            pypatrol config. Subsequent calls are no-ops
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: the ConnectionPool
+def init(config):
+    global pool, writer
+    with pool_lock:
+        if pool is None:
+            db_params = {
+                'host': config['database']['host'],
+                'port': int(config['database']['port']),
+                'database': config['database']['database'],
+                'user': config['database']['user'],
+                'password': config['database']['password']
+            }
+            min_size = int(config['database'].get('pool_min_size', '1'))
+            max_size = int(config['database'].get('pool_max_size', '10'))
+            health_check_interval = int(config['database'].get('pool_health_check_interval', '30'))
+            pool = ConnectionPool(db_params, min_size, max_size, health_check_interval)
+
+            flush_interval = float(config['database'].get('write_flush_interval', '1'))
+            writer = ServiceWriteBuffer(pool, flush_interval)
+            t = threading.Thread(target=writer.run, name='db_writer')
+            t.setDaemon(True)
+            t.start()
+    return pool
+
+# connection()
+#   Purpose: Check out a connection from the process-wide pool for the current thread
+#   Params: (none)
+#   Returns: a context manager yielding a psycopg2 connection
+def connection():
+    return pool.connection()
+
+# dedicated_connection()
+#   Purpose: Check out a connection of the process-wide pool that is not shared with the
+#            thread's other checkouts
+#   Params: (none)
+#   Returns: context manager yielding a psycopg2 connection
+def dedicated_connection():
+    return pool.dedicated()
+
+# queue_service_update()
+#   Purpose: Buffer a service status and/or error_state transition for the next bulk write
+#   Params:
+#     - service_id: id of the service row
+#     - status: new status, or None to leave the status unchanged
+#     - error_state: new error_state
+#   Returns: (none)
+def queue_service_update(service_id, status=None, error_state=False):
+    writer.queue(service_id, status, error_state)
+
+# stats()
+#   Purpose: Metrics for the process-wide pool
+#   Params: (none)
+#   Returns: dictionary of pool metrics, or None if the pool has not been initialized
+def stats():
+    return pool.stats() if pool is not None else None
+
+# connection_counts()
+#   Purpose: Pooled connections by state, read when /metrics is scraped
+#   Params: (none)
+#   Returns: dictionary of (state,) -> number of connections
+def connection_counts():
+    s = stats()
+    if s is None:
+        return {}
+    return { ('idle',): s['idle'], ('in_use',): s['in_use'] }
+
+connections_metric = metrics.Gauge('pypatrol_db_connections', 'Pooled database connections by state', ('state',), function=connection_counts)
+pool_waits_metric = metrics.Counter('pypatrol_db_pool_waits_total', 'Connection checkouts that had to wait for a free connection',
+    function=lambda: pool.waits if pool is not None else 0)
+pool_wait_seconds_metric = metrics.Counter('pypatrol_db_pool_wait_seconds_total', 'Seconds spent waiting for a free connection',
+    function=lambda: pool.wait_time if pool is not None else 0.0)
@@ -0,0 +1,206 @@
+# engine.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: asyncio based check engine. Runs the orchestrate -> fan-out -> consensus flow of
+#          every service check as a coroutine on a single event loop thread instead of one
+#          thread per check plus one thread per worker. HTTP requests to pyPatrol-node workers
+#          share one aiohttp session that keeps keep-alive connections open per node, and a
+#          global semaphore caps the number of checks in flight
+
+import coalesce, consensus, task
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, aiohttp, json, threading, time
+
+# CheckEngine class - owns the event loop, the HTTP session and the concurrency limit
+class CheckEngine():
+    def __init__(self, max_concurrent_checks, node_connections, blocking_threads):
+        self.max_concurrent_checks = max_concurrent_checks # global cap on checks in flight
+        self.node_connections = node_connections # keep-alive connections per pyPatrol-node
+        # database lookups and consensus/notification still use blocking libraries, run them
+        #   on a small fixed pool rather than on the event loop
+        self.executor = ThreadPoolExecutor(max_workers=blocking_threads, thread_name_prefix='engine_blocking')
+        self.loop = None
+        self.session = None
+        self.semaphore = None
+        self.ready = threading.Event()
+        self.pending = 0 # checks submitted but not yet finished
+        self.in_flight = 0 # checks currently holding the semaphore
+
+    # start()
+    #   Purpose: Start the event loop in its own daemon thread and wait until it is ready
+    #   Params: (none)
+    #   Returns: (none)
+    def start(self):
+        t = threading.Thread(target=self.run, name='check_engine')
+        t.setDaemon(True)
+        t.start()
+        self.ready.wait()
+
+    # run()
+    #   Purpose: Event loop thread body, creates the shared HTTP session and runs forever
+    #   Params: (none)
+    #   Returns: (none)
+    def run(self):
+        print("Started check engine (max %s concurrent checks)..." % self.max_concurrent_checks)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_checks)
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.node_connections, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.ready.set()
+        self.loop.run_forever()
+
+    # submit()
+    #   Purpose: Schedule a service check on the engine, safe to call from any thread
+    #   Params:
+    #     - data: service check details
+    #     - workers: array of pypatrol-node worker URIs
+    #   Returns: concurrent.futures.Future completed when the check has finished
+    def submit(self, data, workers):
+        self.loop.call_soon_threadsafe(self.add_pending)
+        return asyncio.run_coroutine_threadsafe(self.orchestrate(data, workers), self.loop)
+
+    # add_pending()
+    #   Purpose: Count a submitted check, runs on the event loop so no lock is needed
+    #   Params: (none)
+    #   Returns: (none)
+    def add_pending(self):
+        self.pending += 1
+
+    # execute_task()
+    #   Purpose: Send the service check request to a pyPatrol-node worker and wait for the
+    #            result, reusing the node's keep-alive connection
+    #   Params:
+    #     - data: service check post data
+    #     - worker_uri: http endpoint to send the task to the pypatrol-node worker
+    #   Returns: the worker's result dictionary
+    async def execute_task(self, data, worker_uri):
+        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+        start = time.monotonic()
+        try:
+            timeout = aiohttp.ClientTimeout(total=task.http_timeout)
+            async with self.session.post(worker_uri, data=json.dumps(data), headers=headers, timeout=timeout) as r:
+                result = json.loads(await r.text())
+            error = False
+        except asyncio.CancelledError:
+            # straggler cancelled once the check was decided, only give back its load
+            task.report_worker_event(worker_uri, 'released')
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(e)
+            result = { 'status': 'error' }
+            error = True
+        latency = time.monotonic() - start
+        task.report_worker_result(worker_uri, latency, error)
+        # kept with the result for the check history
+        result['worker'] = worker_uri.split('/')[2]
+        result['latency'] = latency
+        return result
+
+    # orchestrate()
+    #   Purpose: Coroutine version of task.orchestrate(); fans the check out to the workers
+    #            concurrently, stops waiting (and cancels the stragglers) as soon as the vote is
+    #            settled, hedges slow requests on spare workers and queues the results for
+    #            the consensus evaluator
+    #   Params:
+    #     - data: service check details
+    #     - workers: array of pypatrol-node worker URIs, followed by any spare workers
+    #   Returns: (none)
+    async def orchestrate(self, data, workers):
+        try:
+            # if for some reason no worker URIs were given, exit
+            if workers is None:
+                return
+            async with self.semaphore:
+                self.in_flight += 1
+                try:
+                    service_url, post_data = await self.loop.run_in_executor(None, task.get_service_details, data)
+                    # share the probe with other services checking the same target
+                    probe = coalesce.key(service_url, post_data, consensus.workers_for(data))
+                    if probe is not None:
+                        role, results = coalesce.join(probe, data)
+                        if role == 'cached':
+                            task.check_for_status_change(data, results, False)
+                        if role != 'leader':
+                            task.release_workers(data, workers)
+                            return
+                    try:
+                        results = await self.collect(post_data, service_url, workers, consensus.workers_for(data))
+                    except BaseException:
+                        # release the services waiting on this probe, they are retried next period
+                        if probe is not None:
+                            coalesce.finish(probe, [])
+                        raise
+                    task.check_for_status_change(data, results)
+                    if probe is not None:
+                        for service in coalesce.finish(probe, results):
+                            task.check_for_status_change(service, results, False)
+                finally:
+                    self.in_flight -= 1
+        except Exception as error:
+            print(error)
+        finally:
+            self.pending -= 1
+
+    # collect()
+    #   Purpose: Send a check to its primary workers and gather results until the vote is
+    #            settled, hedging requests still outstanding after hedge_delay on the spares
+    #   Params:
+    #     - post_data: service check post data
+    #     - service_url: endpoint url suffix of the check
+    #     - workers: array of pypatrol-node worker URIs, followed by any spare workers
+    #     - fanout: number of primary workers
+    #   Returns: array with one result (or None) per primary worker
+    async def collect(self, post_data, service_url, workers, fanout):
+        n = min(fanout, len(workers))
+        primaries = workers[:n]
+        spares = workers[n:]
+        results = [None] * n
+        requests = {} # asyncio task -> result slot
+        for i in range(n):
+            requests[asyncio.ensure_future(self.execute_task(post_data, primaries[i] + service_url))] = i
+        hedge_at = self.loop.time() + consensus.hedge_delay if len(spares) > 0 and consensus.hedge_delay > 0 else None
+        try:
+            while (len(requests) > 0):
+                timeout = max(hedge_at - self.loop.time(), 0) if hedge_at is not None else None
+                done, waiting = await asyncio.wait(requests.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    # hedge the slowest requests on the spare workers
+                    for i in range(n):
+                        if results[i] is None and len(spares) > 0:
+                            spare = spares.pop(0)
+                            task.report_worker_event(spare, 'sent')
+                            requests[asyncio.ensure_future(self.execute_task(post_data, spare + service_url))] = i
+                            task.hedges_metric.inc()
+                    hedge_at = None
+                    continue
+                for request in done:
+                    slot = requests.pop(request)
+                    if results[slot] is None:
+                        results[slot] = request.result()
+                outstanding = [primaries[i].split('/')[2] for i in range(n) if results[i] is None]
+                if len(outstanding) == 0:
+                    break
+                if consensus.settled(results, outstanding):
+                    task.early_exit_metric.inc()
+                    break
+        finally:
+            # cancel stragglers and the losing side of hedged requests, freeing their connections
+            for request in requests:
+                request.cancel()
+        return results
+
+    # stats()
+    #   Purpose: Snapshot of the engine's queue depth and concurrency
+    #   Params: (none)
+    #   Returns: dictionary of engine metrics
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'max_concurrent_checks': self.max_concurrent_checks
+        }
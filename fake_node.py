@@ -0,0 +1,155 @@
+# fake_node.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: A local stand-in for a pyPatrol-node worker used by the benchmark harness. Answers
+#          the node's service check endpoints after a tunable delay, reports a wrong status
+#          at a tunable rate, and sends heartbeats to the worker manager's Twisted endpoint
+#          so that it registers like a real node. Also implements the batched /batch endpoint
+#          (NDJSON checks in, NDJSON results streamed back as each check finishes)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json, queue, random, socket, threading, time
+
+# healthy result returned by each service check endpoint
+ENDPOINT_STATUS = {
+    '/ping': 'online',
+    '/ping6': 'online',
+    '/tcp_socket': 'online',
+    '/steam_server': 'online',
+    '/http_response': 'online',
+    '/cert': 'valid'
+}
+
+# FakeNodeHandler class - HTTP handler implementing the pyPatrol-node endpoints
+class FakeNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like a real node behind a web server
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply({ 'status': 'online' })
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.node.requests += 1
+        if self.path == '/batch':
+            self.batch(body)
+        else:
+            self.reply(self.server.node.check(self.path))
+
+    # batch()
+    #   Purpose: Run every check of a batch concurrently and stream each result back as one
+    #            NDJSON line ({"id": n, "result": {...}}) in completion order
+    #   Params:
+    #     - body: request body, one {"id": n, "endpoint": path, "data": {...}} per line
+    #   Returns: (none)
+    def batch(self, body):
+        checks = [json.loads(line) for line in body.decode('utf-8').splitlines() if line.strip()]
+        self.server.node.batched_checks += len(checks)
+        done = queue.Queue()
+        for check in checks:
+            t = threading.Thread(target=lambda c: done.put({ 'id': c['id'], 'result': self.server.node.check(c['endpoint']) }), args=(check,))
+            t.setDaemon(True)
+            t.start()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(len(checks)):
+            line = (json.dumps(done.get()) + '\n').encode('utf-8')
+            self.wfile.write(('%x\r\n' % len(line)).encode('ascii') + line + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+# FakeNode class - one fake pyPatrol-node worker
+class FakeNode():
+    def __init__(self, name, latency=0.0, jitter=0.0, failure_rate=0.0, ipv6=True, region=None):
+        self.name = name
+        self.latency = latency # seconds to wait before answering a check
+        self.jitter = jitter # additional uniformly distributed delay in seconds
+        self.failure_rate = failure_rate # fraction of checks answered with a wrong status
+        self.ipv6 = ipv6
+        self.region = region
+        self.requests = 0 # HTTP requests, a batch counts once
+        self.batched_checks = 0 # checks received through /batch
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeNodeHandler)
+        self.server.daemon_threads = True
+        self.server.node = self
+        self.port = self.server.server_address[1]
+
+    # check()
+    #   Purpose: Produce the result of a service check for an endpoint
+    #   Params:
+    #     - path: endpoint requested by the server
+    #   Returns: result dictionary
+    def check(self, path):
+        delay = self.latency + random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        status = ENDPOINT_STATUS.get(path, 'online')
+        if random.random() < self.failure_rate:
+            status = 'invalid' if status == 'valid' else 'offline'
+        return { 'status': status }
+
+    # heartbeat()
+    #   Purpose: Register with (or check in to) the worker manager's Twisted endpoint
+    #   Params:
+    #     - host: worker manager endpoint host
+    #     - port: worker manager endpoint port
+    #     - secret: secret key accepted by the server
+    #   Returns: (none)
+    def heartbeat(self, host, port, secret):
+        msg = {
+            'name': self.name,
+            'ip': '127.0.0.1',
+            'port': self.port,
+            'ipv4': True,
+            'ipv6': self.ipv6,
+            'ssl': False,
+            'secret': secret
+        }
+        if self.region is not None:
+            msg['region'] = self.region
+        try:
+            s = socket.create_connection((host, port), timeout=5)
+            s.sendall(json.dumps(msg).encode('utf-8'))
+            s.close()
+        except OSError as e:
+            print("fake_node.py: heartbeat - " + self.name + ": " + str(e))
+
+    # start()
+    #   Purpose: Serve HTTP and send heartbeats every interval seconds in daemon threads
+    #   Params:
+    #     - host: worker manager endpoint host
+    #     - port: worker manager endpoint port
+    #     - secret: secret key accepted by the server
+    #     - interval: seconds between heartbeats
+    #   Returns: (none)
+    def start(self, host, port, secret, interval):
+        t = threading.Thread(target=self.server.serve_forever, name='fake_node_' + self.name)
+        t.setDaemon(True)
+        t.start()
+
+        def beat():
+            while (True):
+                self.heartbeat(host, port, secret)
+                time.sleep(interval)
+        h = threading.Thread(target=beat, name='fake_node_heartbeat_' + self.name)
+        h.setDaemon(True)
+        h.start()
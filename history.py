@@ -0,0 +1,326 @@
+# history.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Check result history. Every worker result of every check is queued by the tasks and
+#          appended to the check_result table by a writer thread with one COPY per batch.
+#          check_result is partitioned by day so old days are dropped whole instead of deleted
+#          row by row, and a maintenance thread creates upcoming partitions, enforces retention
+#          and rolls raw results up into per-service, per-hour uptime, latency percentile and
+#          worker disagreement figures in check_rollup
+
+from datetime import datetime, date, timedelta
+import db, metrics
+import psycopg2, io, queue, threading, time
+
+enabled = False
+flush_interval = 2 # seconds between COPY batches
+max_batch = 5000 # results per COPY
+retention_days = 30 # days of raw results kept
+partitions_ahead = 2 # daily partitions created in advance
+rollup_interval = 300 # seconds between rollups
+
+pending = None # queue of check_result rows waiting for the writer
+started = False
+maintenance_started = False
+start_lock = threading.Lock()
+drained = threading.Event() # set once the writer has flushed a batch closed by drain()
+
+# statuses counted as up for uptime
+UP_STATUSES = ('online', 'valid')
+
+COLUMNS = "(checked_at, cert_expiry, service_id, latency, response_code, agrees, up, worker, status)"
+
+ROLLUP_SQL = "INSERT INTO check_rollup (service_id, hour, results, uptime, latency_p50, latency_p95, latency_p99, disagreements) " \
+    "SELECT service_id, date_trunc('hour', checked_at), count(*), avg(up::int), " \
+    "percentile_cont(0.5) WITHIN GROUP (ORDER BY latency), " \
+    "percentile_cont(0.95) WITHIN GROUP (ORDER BY latency), " \
+    "percentile_cont(0.99) WITHIN GROUP (ORDER BY latency), " \
+    "count(*) FILTER (WHERE NOT agrees) " \
+    "FROM check_result WHERE checked_at >= %s GROUP BY 1, 2 " \
+    "ON CONFLICT (service_id, hour) DO UPDATE SET results = EXCLUDED.results, uptime = EXCLUDED.uptime, " \
+    "latency_p50 = EXCLUDED.latency_p50, latency_p95 = EXCLUDED.latency_p95, latency_p99 = EXCLUDED.latency_p99, " \
+    "disagreements = EXCLUDED.disagreements"
+
+# metrics
+written = 0
+dropped = 0
+written_metric = metrics.Counter('pypatrol_check_results_written_total', 'Worker results appended to check_result', function=lambda: written)
+dropped_metric = metrics.Counter('pypatrol_check_results_dropped_total', 'Worker results dropped because the history queue was full', function=lambda: dropped)
+queue_metric = metrics.Gauge('pypatrol_check_results_queue_depth', 'Worker results waiting for the history writer',
+    function=lambda: pending.qsize() if pending is not None else 0)
+
+# copy_value()
+#   Purpose: Encode one value for COPY text format
+#   Params:
+#     - value: column value
+#   Returns: string
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# parse_time()
+#   Purpose: Parse an ISO 8601 time reported by a worker (e.g. a certificate expiry)
+#   Params:
+#     - value: string, or None
+#   Returns: datetime, or None if missing or unparseable
+def parse_time(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+# record()
+#   Purpose: Queue the worker results of one check, never blocks the check path
+#   Params:
+#     - service_id: id of the checked service
+#     - results: array of worker result dictionaries ('worker' and 'latency' added by the task)
+#     - status: consensus status of the check
+#   Returns: (none)
+def record(service_id, results, status):
+    global dropped
+    if not enabled:
+        return
+    now = datetime.now()
+    up = status in UP_STATUSES
+    for result in results:
+        if result is None:
+            continue
+        response_code = result.get('response_code')
+        try:
+            response_code = int(response_code) if response_code is not None else None
+        except (TypeError, ValueError):
+            response_code = None
+        row = (now, parse_time(result.get('cert_expiry')), service_id, result.get('latency'), response_code,
+            result.get('status') == status, up, result.get('worker', ''), result.get('status', 'error'))
+        try:
+            pending.put_nowait(row)
+        except queue.Full:
+            dropped += 1
+
+# flush()
+#   Purpose: Append a batch of results with a single COPY
+#   Params:
+#     - rows: array of check_result rows
+#   Returns: True if the batch was written
+def flush(rows):
+    global written
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(v) for v in row) + '\n')
+    buf.seek(0)
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.copy_expert("COPY check_result " + COLUMNS + " FROM STDIN", buf)
+            conn.commit()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return False
+    written += len(rows)
+    return True
+
+# write()
+#   Purpose: Writer thread body, collects results for up to flush_interval seconds (or
+#            max_batch results) and writes them
+#   Params: (none)
+#   Returns: (none)
+def write():
+    print("Started check result writer thread...")
+    while (True):
+        rows = [pending.get()]
+        batch_end = time.monotonic() + flush_interval
+        # None, queued by drain(), ends the batch early
+        while (len(rows) < max_batch and rows[-1] is not None):
+            remaining = batch_end - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        closed = rows[-1] is None
+        if closed:
+            rows.pop()
+        if len(rows) > 0:
+            flush(rows)
+        if closed:
+            drained.set()
+
+# drain()
+#   Purpose: Write every queued result before shutdown, including the batch the writer is
+#            collecting
+#   Params:
+#     - timeout: seconds to wait for the writer at most
+#   Returns: (none)
+def drain(timeout):
+    if pending is None:
+        return
+    drained.clear()
+    try:
+        pending.put(None, timeout=timeout)
+        drained.wait(timeout)
+    except queue.Full:
+        pass
+    # whatever was queued behind the marker
+    rows = []
+    while (True):
+        try:
+            row = pending.get_nowait()
+        except queue.Empty:
+            break
+        if row is not None:
+            rows.append(row)
+    if len(rows) > 0:
+        flush(rows)
+
+# partition_name()
+#   Purpose: Name of the daily check_result partition for a day
+#   Params:
+#     - day: date
+#   Returns: string
+def partition_name(day):
+    return "check_result_" + day.strftime("%Y%m%d")
+
+# create_partition()
+#   Purpose: Create the check_result partition of a day in its own transaction. Rows of the
+#            day that already landed in the default partition (e.g. the maintenance thread was
+#            down over midnight) would make CREATE ... PARTITION OF fail, so they are moved
+#            into a new table first which is then attached as the day's partition
+#   Params:
+#     - conn: database connection
+#     - day: date
+#   Returns: (none)
+def create_partition(conn, day):
+    name = partition_name(day)
+    bounds = (day, day + timedelta(days=1))
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass(%s)", (name,))
+        if cur.fetchone()[0] is None:
+            # keep the writer from adding rows of the day while they are moved
+            cur.execute("LOCK TABLE check_result_default IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("SELECT EXISTS (SELECT 1 FROM check_result_default WHERE checked_at >= %s AND checked_at < %s)", bounds)
+            if cur.fetchone()[0]:
+                print("history.py: create_partition - moving rows out of check_result_default into " + name)
+                cur.execute("CREATE TABLE " + name + " (LIKE check_result INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+                cur.execute("WITH moved AS (DELETE FROM check_result_default WHERE checked_at >= %s AND checked_at < %s RETURNING *) " \
+                    "INSERT INTO " + name + " SELECT * FROM moved", bounds)
+                cur.execute("ALTER TABLE check_result ATTACH PARTITION " + name + " FOR VALUES FROM (%s) TO (%s)", bounds)
+            else:
+                cur.execute("CREATE TABLE " + name + " PARTITION OF check_result FOR VALUES FROM (%s) TO (%s)", bounds)
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        conn.rollback()
+        print(error)
+    cur.close()
+
+# maintain_partitions()
+#   Purpose: Create the partitions for today and the next partitions_ahead days and drop the
+#            partitions older than retention_days. Every statement commits on its own so one
+#            failing partition does not hold back the others
+#   Params: (none)
+#   Returns: (none)
+def maintain_partitions():
+    today = date.today()
+    try:
+        with db.connection() as conn:
+            for i in range(partitions_ahead + 1):
+                create_partition(conn, today + timedelta(days=i))
+            cur = conn.cursor()
+            cur.execute("SELECT child.relname FROM pg_inherits JOIN pg_class parent ON parent.oid = pg_inherits.inhparent " \
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid WHERE parent.relname = 'check_result'")
+            partitions = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            oldest = partition_name(today - timedelta(days=retention_days))
+            for name in partitions:
+                # check_result_default and names sorting below the oldest kept day
+                if name != 'check_result_default' and name < oldest:
+                    print("history.py: maintain_partitions - dropping " + name)
+                    try:
+                        cur.execute("DROP TABLE " + name)
+                        conn.commit()
+                    except (Exception, psycopg2.DatabaseError) as error:
+                        conn.rollback()
+                        print(error)
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+# rollup()
+#   Purpose: Recompute the check_rollup rows of the previous and the current hour
+#   Params: (none)
+#   Returns: (none)
+def rollup():
+    since = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(ROLLUP_SQL, (since,))
+            conn.commit()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+# maintain()
+#   Purpose: Maintenance thread body, partitions and rollups every rollup_interval seconds
+#   Params: (none)
+#   Returns: (none)
+def maintain():
+    print("Started check result maintenance thread...")
+    while (True):
+        time.sleep(rollup_interval)
+        maintain_partitions()
+        rollup()
+
+# init()
+#   Purpose: Apply the [history] settings and start the writer thread on first call. Later
+#            calls (config reload) only update settings
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def init(config):
+    global enabled, flush_interval, max_batch, retention_days, partitions_ahead, rollup_interval, pending, started
+    if not config.has_section('history'):
+        return
+    enabled = config['history'].getboolean('enabled', False)
+    flush_interval = float(config['history'].get('flush_interval', '2'))
+    max_batch = int(config['history'].get('max_batch', '5000'))
+    retention_days = int(config['history'].get('retention_days', '30'))
+    partitions_ahead = int(config['history'].get('partitions_ahead', '2'))
+    rollup_interval = int(config['history'].get('rollup_interval', '300'))
+    if not enabled:
+        return
+
+    with start_lock:
+        if started:
+            return
+        started = True
+        pending = queue.Queue(maxsize=int(config['history'].get('queue_size', '100000')))
+        t = threading.Thread(target=write, name='history_writer')
+        t.setDaemon(True)
+        t.start()
+
+# start_maintenance()
+#   Purpose: Create the partitions needed now and start the maintenance thread, once per
+#            process (the task manager / scheduler process)
+#   Params: (none)
+#   Returns: (none)
+def start_maintenance():
+    global maintenance_started
+    with start_lock:
+        if not enabled or maintenance_started:
+            return
+        maintenance_started = True
+    maintain_partitions()
+    t = threading.Thread(target=maintain, name='history_maintenance')
+    t.setDaemon(True)
+    t.start()
@@ -5,9 +5,14 @@
 # Last Updated: 11 Oct 2018
 #
 # Purpose: Kicks off the pyPatrol-server workflow by spawing the worker manager and
-#          the task manager threads
+#          the task manager threads, or, in multi-process mode, supervises separate worker
+#          manager, scheduler and check executor processes that talk over ZeroMQ
 
-import threading, time
+import functools, multiprocessing, os, signal, threading, time
+import admission, cluster, db, history, notifier, settings
+
+# set once a SIGTERM has started the shutdown of this process
+shutting_down = threading.Event()
 
 def run_worker_mgr():
     import worker_mgr
@@ -17,7 +22,142 @@ def run_task_mgr():
     import task_mgr
     task_mgr.main()
 
+def run_scheduler():
+    import task_mgr
+    task_mgr.main(distributed=True)
+
+def run_executor(index):
+    import task_mgr
+    task_mgr.executor_main(index)
+
+# shutdown()
+#   Purpose: Deliver what this process still buffers (digest alerts, check history, service
+#            status writes), leave the cluster and exit. Bounded so it finishes within the
+#            supervisor's 10 second grace period
+#   Params: (none)
+#   Returns: (none)
+def shutdown():
+    print("main.py: shutdown - flushing buffers (pid %s)" % os.getpid())
+    try:
+        if cluster.enabled:
+            cluster.leave()
+        notifier.drain(5)
+        history.drain(2)
+        if db.writer is not None:
+            db.writer.flush()
+    except Exception as error:
+        print(error)
+    # skip atexit, the cluster lease is already given up and the daemon threads are mid-work
+    os._exit(0)
+
+# terminate()
+#   Purpose: SIGTERM handler, runs shutdown() in its own thread so it never waits on a lock
+#            held by the interrupted main thread. Repeated signals are ignored
+#   Params:
+#     - signum: signal number
+#     - frame: interrupted stack frame
+#   Returns: (none)
+def terminate(signum, frame):
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    threading.Thread(target=shutdown, name='shutdown').start()
+
+# run_child()
+#   Purpose: Process entry point for a supervised child. Replaces the supervisor's signal
+#            handlers (inherited through fork) with a graceful SIGTERM shutdown and runs the
+#            component
+#   Params:
+#     - target: component entry point
+#   Returns: (none)
+def run_child(target):
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is handled by the supervisor
+    target()
+
+# supervise()
+#   Purpose: Run the worker manager, the scheduler and N check executors as separate
+#            processes, restart any that crash (with backoff) and shut them all down
+#            gracefully on SIGTERM/SIGINT. SIGHUP is forwarded so every child reloads its config
+#   Params:
+#     - executors: number of check executor processes
+#   Returns: (none)
+def supervise(executors):
+    targets = { 'worker_mgr': run_worker_mgr, 'scheduler': run_scheduler }
+    for i in range(executors):
+        targets['executor_%s' % i] = functools.partial(run_executor, i)
+
+    processes = {} # name -> Process
+    started = {} # name -> time of the last start
+    delays = {} # name -> current restart backoff in seconds
+    stopping = threading.Event()
+
+    def start(name):
+        p = multiprocessing.Process(target=run_child, args=(targets[name],), name=name)
+        p.start()
+        processes[name] = p
+        started[name] = time.monotonic()
+        print("main.py: supervise - started %s (pid %s)" % (name, p.pid))
+
+    def stop(signum, frame):
+        stopping.set()
+
+    def forward_sighup(signum, frame):
+        for p in processes.values():
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGHUP)
+
+    # worker manager first so the dispatcher is listening when the scheduler starts polling
+    for name in targets:
+        start(name)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, forward_sighup)
+
+    last_report = 0
+    while (not stopping.is_set()):
+        now = time.monotonic()
+        for name, p in list(processes.items()):
+            if p.is_alive():
+                continue
+            # reset the backoff of children that stayed up for a while before exiting
+            if now - started[name] > 60:
+                delays[name] = 1
+            delay = delays.get(name, 1)
+            print("main.py: supervise - %s exited with code %s, restarting in %ss" % (name, p.exitcode, delay))
+            if stopping.wait(delay):
+                break
+            delays[name] = min(delay * 2, 60)
+            start(name)
+        if now - last_report >= 120:
+            print('pyPatrol... chugging along! (%s processes)' % len([p for p in processes.values() if p.is_alive()]))
+            last_report = now
+        stopping.wait(1)
+
+    print("main.py: supervise - shutting down")
+    for p in processes.values():
+        if p.is_alive():
+            p.terminate()
+    deadline = time.monotonic() + 10
+    for p in processes.values():
+        p.join(max(deadline - time.monotonic(), 0))
+        if p.is_alive():
+            p.kill()
+            p.join()
+
 def main():
+    # load pypatrol.conf once for every component, reload it on SIGHUP
+    config = settings.load()
+
+    # multi-process mode: one process per component, checks spread over N executor processes
+    if config.has_section('main') and config['main'].get('mode', 'threads') == 'processes':
+        supervise(int(config['main'].get('executors', str(os.cpu_count() or 1))))
+        return
+
+    settings.install_sighup_handler()
+    signal.signal(signal.SIGTERM, terminate)
+
     # Start Worker Manager thread
     wm = threading.Thread(target=run_worker_mgr, name='worker_mgr')
     wm.setDaemon(True)
@@ -31,6 +171,9 @@ def main():
     # Keep alive
     while (True):
         print('pyPatrol... chugging along!')
+        if db.stats() is not None:
+            print('db pool: %s' % db.stats())
+        print('admission: %s' % admission.stats())
         time.sleep(120)
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+# metrics.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: In-process metrics (counters, gauges and histograms) in the Prometheus text
+#          exposition format, served at /metrics by the Twisted reactor. Modules create their
+#          metrics at import time and update them on the hot path; gauges that mirror existing
+#          stats() snapshots are read only when the endpoint is scraped
+
+import threading
+
+registry = [] # every metric created in this process, in creation order
+
+# default histogram buckets, seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# format_value()
+#   Purpose: Format a sample value the way Prometheus expects it
+#   Params:
+#     - value: number
+#   Returns: string
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# format_labels()
+#   Purpose: Format a label set, e.g. {worker="1.2.3.4:80"}
+#   Params:
+#     - names: array of label names
+#     - values: array of label values
+#   Returns: string (empty when there are no labels)
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+# Metric class - base of every metric, holds one value per label set. A metric created with a
+#   function has no stored values; the function is called on scrape and returns either a
+#   number or a dictionary of label values tuple -> number
+class Metric():
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {} # label values tuple -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    # samples()
+    #   Purpose: Current samples of the metric
+    #   Params: (none)
+    #   Returns: array of (name suffix, label names, label values, value)
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            if not isinstance(value, dict):
+                value = { (): value }
+            return [('', self.labelnames, labels, v) for labels, v in value.items()]
+        with self.lock:
+            return [('', self.labelnames, labels, v) for labels, v in self.values.items()]
+
+    # render()
+    #   Purpose: Render the metric in the Prometheus text exposition format
+    #   Params: (none)
+    #   Returns: string
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, labels, value in self.samples():
+            lines.append(self.name + suffix + format_labels(names, labels) + ' ' + format_value(value))
+        return '\n'.join(lines)
+
+# Counter class - monotonically increasing value
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+# Gauge class - value that goes up and down
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+# Histogram class - cumulative bucket counts, sum and count of observed values
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, description, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    # observe()
+    #   Purpose: Record one value
+    #   Params:
+    #     - value: observed value
+    #     - labels: tuple of label values
+    #   Returns: (none)
+    def observe(self, value, labels=()):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[labels] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append(('_bucket', names, labels + (format_value(bound),), cumulative))
+                samples.append(('_sum', self.labelnames, labels, total))
+                samples.append(('_count', self.labelnames, labels, count))
+        return samples
+
+# process wide metrics
+threads = Gauge('pypatrol_threads', 'Number of live threads in this process', function=threading.active_count)
+
+# render()
+#   Purpose: Render every registered metric
+#   Params: (none)
+#   Returns: string in the Prometheus text exposition format
+def render():
+    sections = []
+    for metric in list(registry):
+        try:
+            sections.append(metric.render())
+        except Exception as error:
+            print("metrics.py: render - %s: %s" % (metric.name, error))
+    return '\n'.join(sections) + '\n'
+
+# listen()
+#   Purpose: Serve /metrics on the Twisted reactor
+#   Params:
+#     - port: TCP port to listen on
+#   Returns: (none)
+def listen(port):
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    # MetricsPage class - /metrics resource
+    class MetricsPage(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return render().encode('utf-8')
+
+    root = Resource()
+    root.putChild(b'metrics', MetricsPage())
+    reactor.listenTCP(port, Site(root))
+    print("metrics.py: listen - serving /metrics on port %s" % port)
+
+# init()
+#   Purpose: Start the /metrics endpoint if enabled in the [metrics] section. Processes that do
+#            not run the reactor themselves (multi-process mode) start it in a daemon thread
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#     - offset: added to the configured port, one port per process in multi-process mode
+#     - run_reactor: True to run the reactor in a background thread
+#   Returns: (none)
+def init(config, offset=0, run_reactor=False):
+    if not config.has_section('metrics') or not config['metrics'].getboolean('enabled', False):
+        return
+    listen(int(config['metrics'].get('port', '9108')) + offset)
+    if run_reactor:
+        from twisted.internet import reactor
+        t = threading.Thread(target=reactor.run, kwargs={ 'installSignalHandlers': 0 }, name='metrics_reactor')
+        t.setDaemon(True)
+        t.start()
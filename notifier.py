@@ -0,0 +1,285 @@
+# notifier.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Delivers status change alerts off the check path. Each alert fans out to every
+#          contact of the user through the sender registered for the contact's alert_type.
+#          Email alerts are queued, coalesced into one digest email per alert contact per
+#          digest_window, and sent by a small pool of sender threads that each keep a
+#          persistent, reconnecting SMTP connection, rate limited to max_messages_per_sec
+
+import metrics
+import smtplib, queue, threading, time
+
+# initialize smtp parameters
+smtp_server = ""
+smtp_port = 0
+smtp_user = ""
+smtp_pass = ""
+
+# initialize notification parameters
+digest_window = 30 # seconds alerts for the same contact are collected before sending
+smtp_connections = 2 # sender threads, each holding one SMTP connection
+max_messages_per_sec = 5.0
+
+alerts = None # queue of (contact, service name, status, time) from the tasks
+outbox = queue.Queue() # digests waiting for a sender thread
+collected = threading.Event() # set once the collector has handed out a window closed by drain()
+started = False
+start_lock = threading.Lock()
+
+# metrics
+alerts_queued = 0
+alerts_dropped = 0
+messages_sent = 0
+send_failures = 0
+reconnects = 0
+
+# RateLimiter class - token bucket shared by the sender threads
+class RateLimiter():
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # acquire()
+    #   Purpose: Block until a message may be sent
+    #   Params: (none)
+    #   Returns: (none)
+    def acquire(self):
+        while (True):
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+limiter = RateLimiter(max_messages_per_sec)
+
+# format_message()
+#   Purpose: Build the alert email for one contact
+#   Params:
+#     - changes: array of (service name, status, time) for the contact
+#   Returns: message string
+def format_message(changes):
+    if len(changes) == 1:
+        name, status, when = changes[0]
+        return "\nHello,\n\nYour service " + name + " has been detected as " + status + " at " \
+            + when.strftime("%Y-%m-%d %H:%M:%S") + ".\n\n" + "Regards,\n-pyPatrol Team"
+    lines = ["  - " + name + " has been detected as " + status + " at " + when.strftime("%Y-%m-%d %H:%M:%S")
+        for name, status, when in changes]
+    return "\nHello,\n\nThe following services have changed state:\n\n" + "\n".join(lines) \
+        + "\n\n" + "Regards,\n-pyPatrol Team"
+
+# queue_email()
+#   Purpose: Queue an email alert for delivery, never blocks the check path
+#   Params:
+#     - contact: email address of the alert contact
+#     - name: service name
+#     - status: new status of the service
+#     - when: time the status change was detected
+#   Returns: True if the alert was queued, False if the queue is full
+def queue_email(contact, name, status, when):
+    global alerts_queued, alerts_dropped
+    try:
+        alerts.put_nowait((contact, name, status, when))
+        alerts_queued += 1
+        return True
+    except queue.Full:
+        alerts_dropped += 1
+        print("notifier.py: queue_email - alert queue full, dropping alert for " + name)
+        return False
+
+# EmailSender class - alert sender for alert_type 1 (Email), delivers through the digest queue
+#   Senders for other alert types implement the same send(value, name, status, when) method
+#   and are added with register_sender()
+class EmailSender():
+    def send(self, value, name, status, when):
+        return queue_email(value, name, status, when)
+
+# alert_type id (alert_types table) -> sender
+senders = { 1: EmailSender() }
+
+# register_sender()
+#   Purpose: Plug in the sender used for an alert type
+#   Params:
+#     - alert_type: id of the alert type (alert_types table)
+#     - sender: object with a send(value, name, status, when) method
+#   Returns: (none)
+def register_sender(alert_type, sender):
+    senders[alert_type] = sender
+
+# notify()
+#   Purpose: Fan a status change out to every alert contact of the user
+#   Params:
+#     - contacts: array of AlertContact (alert_contacts.py)
+#     - name: service name
+#     - status: new status of the service
+#     - when: time the status change was detected
+#   Returns: number of contacts the alert was handed to
+def notify(contacts, name, status, when):
+    delivered = 0
+    for contact in contacts:
+        sender = senders.get(contact.alert_type)
+        if sender is None:
+            print("notifier.py: notify - no sender for alert type %s (contact %s)" % (contact.alert_type, contact.id))
+            continue
+        try:
+            if sender.send(contact.value, name, status, when) is not False:
+                delivered += 1
+        except Exception as error:
+            print(error)
+    return delivered
+
+# collect()
+#   Purpose: Group queued alerts per contact and hand one digest per contact to the senders
+#            every digest_window seconds
+#   Params: (none)
+#   Returns: (none)
+def collect():
+    print("Started notification collector thread...")
+    while (True):
+        # wait for the first alert of a window, then gather everything that arrives until it
+        #   closes (None, queued by drain(), closes it early)
+        first = alerts.get()
+        if first is None:
+            collected.set()
+            continue
+        pending = { first[0]: [first[1:]] }
+        window_end = time.monotonic() + digest_window
+        closed = False
+        while (True):
+            remaining = window_end - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                alert = alerts.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if alert is None:
+                closed = True
+                break
+            pending.setdefault(alert[0], []).append(alert[1:])
+        for contact, changes in pending.items():
+            outbox.put((contact, format_message(changes)))
+        if closed:
+            collected.set()
+
+# connect()
+#   Purpose: Open and authenticate an SMTP connection to the mail relay
+#   Params: (none)
+#   Returns: an smtplib connection
+def connect():
+    global reconnects
+    reconnects += 1
+    server = smtplib.SMTP_SSL(smtp_server, smtp_port)
+    server.login(smtp_user, smtp_pass)
+    return server
+
+# send()
+#   Purpose: Sender thread body, delivers digests over one persistent SMTP connection and
+#            reconnects (retrying the message once) when the relay drops it
+#   Params: (none)
+#   Returns: (none)
+def send():
+    global messages_sent, send_failures
+    server = None
+    while (True):
+        contact, msg = outbox.get()
+        limiter.acquire()
+        for attempt in range(2):
+            try:
+                if server is None:
+                    server = connect()
+                server.sendmail(smtp_user, contact, msg)
+                messages_sent += 1
+                break
+            except (smtplib.SMTPException, OSError) as error:
+                print("notifier.py: send - " + str(error))
+                try:
+                    if server is not None:
+                        server.close()
+                except (smtplib.SMTPException, OSError):
+                    pass
+                server = None
+                if attempt == 1:
+                    send_failures += 1
+        outbox.task_done()
+
+# drain()
+#   Purpose: Close the current digest window and wait for every digest to be sent, on shutdown
+#   Params:
+#     - timeout: seconds to wait at most
+#   Returns: (none)
+def drain(timeout):
+    if alerts is None:
+        return
+    deadline = time.monotonic() + timeout
+    collected.clear()
+    try:
+        alerts.put(None, timeout=timeout)
+    except queue.Full:
+        return
+    collected.wait(max(deadline - time.monotonic(), 0))
+    while (outbox.unfinished_tasks > 0 and time.monotonic() < deadline):
+        time.sleep(0.1)
+
+# init()
+#   Purpose: Apply the [mail] settings from the pypatrol config and start the collector and
+#            sender threads on first call. Later calls (config reload) only update settings
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def init(config):
+    global smtp_server, smtp_port, smtp_user, smtp_pass
+    global digest_window, smtp_connections, max_messages_per_sec, alerts, started
+    smtp_server = config['mail']['smtp_server']
+    smtp_port = int(config['mail']['smtp_port'])
+    smtp_user = config['mail']['smtp_user']
+    smtp_pass = config['mail']['smtp_password']
+    digest_window = float(config['mail'].get('digest_window', '30'))
+    max_messages_per_sec = float(config['mail'].get('max_messages_per_sec', '5'))
+    limiter.rate = max_messages_per_sec
+
+    with start_lock:
+        if started:
+            return
+        started = True
+        smtp_connections = int(config['mail'].get('smtp_connections', '2'))
+        alerts = queue.Queue(maxsize=int(config['mail'].get('queue_size', '10000')))
+        c = threading.Thread(target=collect, name='notifier_collect')
+        c.setDaemon(True)
+        c.start()
+        for i in range(smtp_connections):
+            s = threading.Thread(target=send, name='notifier_send_%s' % i)
+            s.setDaemon(True)
+            s.start()
+
+# stats()
+#   Purpose: Snapshot of the notification pipeline metrics
+#   Params: (none)
+#   Returns: dictionary of notifier metrics
+def stats():
+    return {
+        'alerts_queued': alerts_queued,
+        'alerts_dropped': alerts_dropped,
+        'queue_depth': alerts.qsize() if alerts is not None else 0,
+        'outbox_depth': outbox.qsize(),
+        'messages_sent': messages_sent,
+        'send_failures': send_failures,
+        'smtp_connects': reconnects
+    }
+
+queue_depth_metric = metrics.Gauge('pypatrol_notification_queue_depth', 'Alerts waiting to be collected and digests waiting to be sent', ('queue',),
+    function=lambda: { ('alerts',): alerts.qsize() if alerts is not None else 0, ('outbox',): outbox.qsize() })
+alerts_metric = metrics.Counter('pypatrol_notification_alerts_total', 'Alerts handed to the notifier by outcome', ('outcome',),
+    function=lambda: { ('queued',): alerts_queued, ('dropped',): alerts_dropped })
+messages_metric = metrics.Counter('pypatrol_notification_messages_total', 'Digest emails by outcome', ('outcome',),
+    function=lambda: { ('sent',): messages_sent, ('failed',): send_failures })
@@ -0,0 +1,139 @@
+# payloads.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: In-memory cache of the request each service check sends to a pyPatrol-node
+#          worker (endpoint + POST body). Payloads for a whole poll are fetched with one
+#          JOINed query, and an entry is refetched when its service row's updated_at changes
+#          (the service detail tables bump it through triggers) or after payload_cache_ttl
+
+from collections import namedtuple
+import db
+import psycopg2, threading, time
+
+# CheckPayload - endpoint url suffix and POST body for a service check
+CheckPayload = namedtuple('CheckPayload', ['service_url', 'post_data'])
+
+# pyPatrol-node endpoint per ip_port_service service type
+IP_PORT_URLS = { 1: "/ping", 2: "/ping6", 5: "/tcp_socket", 6: "/steam_server" }
+
+# every service detail table joined onto the service row in one query
+PAYLOAD_SQL = "SELECT service.id, service.type, service.updated_at, " \
+    "ip_port_service.ip_host, ip_port_service.port, " \
+    "http_service.hostname, http_service.redirects, http_service.check_string, http_service.keywords, " \
+    "cert_service.hostname, cert_service.buffer " \
+    "FROM service " \
+    "LEFT JOIN ip_port_service ON ip_port_service.service_id = service.id " \
+    "LEFT JOIN http_service ON http_service.service_id = service.id " \
+    "LEFT JOIN cert_service ON cert_service.service_id = service.id " \
+    "WHERE service.id = ANY(%s)"
+
+# cache entries: service id -> (service updated_at, fetch time, CheckPayload)
+cache = {}
+cache_lock = threading.Lock()
+ttl = 300 # seconds before an entry is refetched even if its service row did not change
+
+# build_payload()
+#   Purpose: Turn a row of PAYLOAD_SQL into the request for the service's check type
+#   Params:
+#     - row: result row of PAYLOAD_SQL
+#   Returns: CheckPayload, or None for an unknown service type
+def build_payload(row):
+    service_type = row[1]
+    # ip_port_service service check type
+    if (service_type in IP_PORT_URLS):
+        port = row[4] if row[4] is not None else ""
+        return CheckPayload(IP_PORT_URLS[service_type], { 'ip': row[3], 'port': port })
+    # http_service service check type
+    elif (service_type == 3):
+        return CheckPayload("/http_response", {
+            'hostname': row[5],
+            'redirects': row[6],
+            'check_string': row[7],
+            'keywords': row[8]
+        })
+    # cert_service service check type
+    elif (service_type == 4):
+        return CheckPayload("/cert", { 'hostname': row[9], 'buffer': int(row[10]) })
+    return None
+
+# fresh()
+#   Purpose: Determine whether the cached payload for a service row can be used
+#   Params:
+#     - service: service row (SELECT * FROM service column order)
+#   Returns: the cached CheckPayload, or None if it is missing or stale
+def fresh(service):
+    entry = cache.get(service[0])
+    if entry is None:
+        return None
+    updated_at, fetched, payload = entry
+    if updated_at != service[11] or time.monotonic() - fetched > ttl:
+        return None
+    return payload
+
+# prefetch()
+#   Purpose: Make sure the payloads of all given services are cached, fetching every missing
+#            or stale one in a single query
+#   Params:
+#     - services: array of service rows
+#   Returns: (none)
+def prefetch(services):
+    with cache_lock:
+        missing = [s[0] for s in services if fresh(s) is None]
+    if len(missing) == 0:
+        return
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(PAYLOAD_SQL, (missing,))
+            rows = cur.fetchall()
+            cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+    now = time.monotonic()
+    with cache_lock:
+        for row in rows:
+            try:
+                cache[row[0]] = (row[2], now, build_payload(row))
+            except (TypeError, ValueError) as error:
+                print("payloads.py: prefetch - bad details for service %s: %s" % (row[0], error))
+
+# get()
+#   Purpose: Return the payload for a service check, fetching it if it was not prefetched
+#   Params:
+#     - service: service row (SELECT * FROM service column order)
+#   Returns: CheckPayload, or None if the service details could not be loaded
+def get(service):
+    with cache_lock:
+        payload = fresh(service)
+    if payload is None:
+        prefetch([service])
+        with cache_lock:
+            entry = cache.get(service[0])
+        payload = entry[2] if entry is not None else None
+    return payload
+
+# invalidate()
+#   Purpose: Drop cached payloads, e.g. after the service detail tables were changed directly
+#   Params:
+#     - service_ids: array of service ids, or None to clear the whole cache
+#   Returns: (none)
+def invalidate(service_ids=None):
+    with cache_lock:
+        if service_ids is None:
+            cache.clear()
+        else:
+            for service_id in service_ids:
+                cache.pop(service_id, None)
+
+# configure()
+#   Purpose: Apply the payload cache settings from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global ttl
+    ttl = int(config['tasks'].get('payload_cache_ttl', '300'))
@@ -0,0 +1,129 @@
+# phase.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Phase-spread scheduling. Every service gets a stable phase offset within its
+#          interval and is checked when (unix time mod interval) == offset. When a check is
+#          dispatched its last_check_time is stamped on the nearest point of that grid rather
+#          than at NOW(), so services created together (or sharing an interval) drift apart
+#          after one check and then stay spread out. Offsets come from a golden ratio (Weyl)
+#          sequence over service.id, which spaces consecutive ids evenly over the interval
+#          instead of clustering them like a plain hash can. Run directly to print the
+#          expected per-second check load of the service table:
+#            python3 phase.py [--window 3600]
+
+import db, settings
+import argparse, json, math
+
+enabled = False
+
+GOLDEN = 0.6180339887498949
+
+# offset of a service within its interval (seconds), see offset()
+OFFSET_SQL = "floor(((service.id * " + str(GOLDEN) + ") - floor(service.id * " + str(GOLDEN) + ")) * service.interval)"
+
+# seconds to move NOW() to reach the nearest phase slot of a service, see adjust()
+ADJUST_SQL = "((" + OFFSET_SQL + " - EXTRACT(EPOCH FROM NOW())) - service.interval * " \
+    "round((" + OFFSET_SQL + " - EXTRACT(EPOCH FROM NOW())) / service.interval))"
+
+# last_check_time to stamp on a dispatched service, NOW() moved onto its phase grid
+STAMP_SQL = "NOW() + (" + ADJUST_SQL + " * interval '1 sec')"
+
+# offset()
+#   Purpose: Stable phase offset of a service within its interval
+#   Params:
+#     - service_id: id of the service
+#     - interval: check interval of the service in seconds
+#   Returns: seconds (0 <= offset < interval)
+def offset(service_id, interval):
+    return math.floor(((service_id * GOLDEN) % 1.0) * interval)
+
+# adjust()
+#   Purpose: Seconds to add to a dispatch time to put it on the nearest phase slot of a
+#            service (between -interval/2 and interval/2)
+#   Params:
+#     - service_id: id of the service
+#     - interval: check interval of the service in seconds
+#     - now: unix time of the dispatch
+#   Returns: seconds
+def adjust(service_id, interval, now):
+    d = offset(service_id, interval) - now
+    return d - interval * round(d / interval)
+
+# stamp_sql()
+#   Purpose: SQL expression for the last_check_time of a dispatched service
+#   Params: (none)
+#   Returns: string
+def stamp_sql():
+    return STAMP_SQL if enabled else "NOW()"
+
+# histogram()
+#   Purpose: Expected number of checks starting in every second of a window once all
+#            services run on their phase grid
+#   Params:
+#     - services: array of (service id, interval)
+#     - window: seconds to report
+#   Returns: array of check counts, one per second of the window
+def histogram(services, window):
+    load = [0] * window
+    for service_id, interval in services:
+        if interval <= 0:
+            continue
+        for t in range(offset(service_id, interval), window, interval):
+            load[t] += 1
+    return load
+
+# summarize()
+#   Purpose: Capacity planning summary of a load histogram
+#   Params:
+#     - load: array of check counts per second
+#   Returns: dictionary of load figures
+def summarize(load):
+    mean = sum(load) / len(load) if len(load) > 0 else 0.0
+    peak = max(load) if len(load) > 0 else 0
+    return {
+        'seconds': len(load),
+        'checks': sum(load),
+        'mean_per_sec': mean,
+        'peak_per_sec': peak,
+        'min_per_sec': min(load) if len(load) > 0 else 0,
+        'peak_to_mean': peak / mean if mean > 0 else None,
+        'stddev_per_sec': math.sqrt(sum((x - mean) ** 2 for x in load) / len(load)) if len(load) > 0 else 0.0
+    }
+
+# configure()
+#   Purpose: Apply the phase spreading setting from the pypatrol config
+#   Params:
+#     - config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def configure(config):
+    global enabled
+    enabled = config['tasks'].getboolean('phase_spread', False)
+
+# main()
+#   Purpose: Print the expected per-second load histogram of the active services
+#   Params: (none)
+#   Returns: (none)
+def main():
+    parser = argparse.ArgumentParser(description='pyPatrol-server per-second check load report')
+    parser.add_argument('--window', type=int, default=3600, help='seconds to report')
+    parser.add_argument('--histogram', action='store_true', help='include the per-second counts')
+    args = parser.parse_args()
+
+    db.init(settings.load())
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, interval FROM service WHERE active")
+        services = cur.fetchall()
+        cur.close()
+
+    load = histogram(services, args.window)
+    report = summarize(load)
+    if args.histogram:
+        report['load'] = load
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# scheduler.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: In-memory deadline scheduler for service checks. Loads the service table once into
+#          a heap keyed by each service's next due time, incrementally refreshes only the rows
+#          that changed (via the service.updated_at cursor), and hands each check to the task
+#          manager at its exact deadline rather than in db_poll_interval sized batches
+
+import admission, cluster, db, metrics, phase
+import psycopg2, heapq, threading, time
+
+# seconds until a service is due, computed by the database so that the server and database
+# clocks never have to agree with each other
+DUE_IN_SQL = "EXTRACT(EPOCH FROM (service.last_check_time + (service.interval * interval '1 sec') - NOW()))"
+
+load_duration_metric = metrics.Histogram('pypatrol_scheduler_load_duration_seconds', 'Duration of deadline scheduler loads', ('kind',))
+load_rows_metric = metrics.Histogram('pypatrol_scheduler_load_rows', 'Service rows read per deadline scheduler load', ('kind',),
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000))
+
+# DeadlineScheduler class - keeps every service in a min-heap ordered by next due time
+class DeadlineScheduler():
+    def __init__(self, dispatch, refresh_interval, resync_interval):
+        self.dispatch = dispatch # called with due service rows and their lag, returns the deferred rows
+        self.refresh_interval = refresh_interval # seconds between incremental refreshes
+        self.resync_interval = resync_interval # seconds between full reloads (catches deletes)
+        self.heap = [] # (due time, service id, version) entries, stale versions are skipped
+        self.services = {} # service id -> [row, version, interval, last dispatch time (moved onto
+                           #   the service's phase grid when phase spreading is enabled), due time
+                           #   of the pending check, due time of the last dispatched check]
+        self.cursor = None # newest service.updated_at value seen so far
+        self.clock_offset = 0.0 # seconds the database clock is ahead of time.time(), for phase slots
+        self.cluster_version = None # cluster ownership version of the last full load
+        self.next_refresh = 0
+        self.next_resync = 0
+        self.lock = threading.Lock()
+
+    # schedule()
+    #   Purpose: Insert or replace a service in the heap. Entries are never removed from the
+    #            heap directly; bumping the version makes any older entry stale instead
+    #   Params:
+    #     - row: service row (SELECT * FROM service column order)
+    #     - due_in: seconds until the service is due according to the database
+    #   Returns: (none)
+    def schedule(self, row, due_in):
+        now = time.monotonic()
+        entry = self.services.get(row[0])
+        if entry is not None and entry[3] is not None:
+            # the service was dispatched by this scheduler, trust our own dispatch time over the
+            # database's last_check_time since that update may not have been committed yet
+            due = entry[3] + row[8]
+            version = entry[1] + 1
+            self.services[row[0]] = [row, version, row[8], entry[3], due, entry[5]]
+        else:
+            due = now + float(due_in)
+            version = entry[1] + 1 if entry is not None else 0
+            self.services[row[0]] = [row, version, row[8], None, due, None]
+        heapq.heappush(self.heap, (due, row[0], version))
+
+    # load()
+    #   Purpose: Fetch service rows from the database and (re)schedule them. A full load
+    #            replaces the in-memory table so that deleted services are dropped
+    #   Params:
+    #     - full: True to reload the whole service table, False for changed rows only
+    #   Returns: (none)
+    def load(self, full):
+        # in cluster mode only the buckets owned by this instance are scheduled
+        where = "TRUE"
+        params = ()
+        if cluster.enabled:
+            buckets, self.cluster_version = cluster.owned()
+            where = "(service.id %% %s) = ANY(%s)"
+            params = (cluster.BUCKETS, buckets)
+        start = time.monotonic()
+        try:
+            with db.connection() as conn:
+                cur = conn.cursor()
+                # phase slots are placed on the database's clock, which stamps last_check_time
+                sent = time.time()
+                cur.execute("SELECT EXTRACT(EPOCH FROM NOW())")
+                self.clock_offset = float(cur.fetchone()[0]) - (sent + time.time()) / 2
+                if full or self.cursor is None:
+                    cur.execute("SELECT service.*, " + DUE_IN_SQL + " FROM service WHERE " + where, params)
+                else:
+                    # overlap the cursor by one refresh interval so rows stamped by transactions that
+                    # committed after our previous refresh are not missed
+                    cur.execute("SELECT service.*, " + DUE_IN_SQL + " FROM service " \
+                        "WHERE service.updated_at > %s - (%s * interval '1 sec') AND " + where,
+                        (self.cursor, self.refresh_interval) + params)
+                rows = cur.fetchall()
+                cur.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+            return
+        kind = 'full' if full else 'refresh'
+        load_duration_metric.observe(time.monotonic() - start, (kind,))
+        load_rows_metric.observe(len(rows), (kind,))
+
+        with self.lock:
+            if full:
+                seen = set(row[0] for row in rows)
+                for service_id in list(self.services.keys()):
+                    if service_id not in seen:
+                        del self.services[service_id]
+            for row in rows:
+                self.schedule(row[:-1], row[-1])
+                if self.cursor is None or row[11] > self.cursor:
+                    self.cursor = row[11]
+            if full:
+                # drop stale entries so the heap does not grow without bound
+                self.heap = [e for e in self.heap if e[1] in self.services and self.services[e[1]][1] == e[2]]
+                heapq.heapify(self.heap)
+        print("scheduler.py: load - %s %s rows" % ("loaded" if full else "refreshed", len(rows)))
+
+    # pop_due()
+    #   Purpose: Remove every service whose deadline has passed and reschedule it one interval
+    #            after now
+    #   Params: (none)
+    #   Returns: tuple of (array of due service rows, array of seconds each row is overdue)
+    def pop_due(self):
+        due = []
+        lags = []
+        with self.lock:
+            now = time.monotonic()
+            wall = time.time() + self.clock_offset
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                deadline, service_id, version = heapq.heappop(self.heap)
+                entry = self.services.get(service_id)
+                if entry is None or entry[1] != version:
+                    continue # stale entry
+                due.append(entry[0])
+                # lag from the check's due time, not from a retry deadline set by defer()
+                lags.append(now - entry[4])
+                entry[1] += 1
+                # mirror the last_check_time the task manager stamps for the dispatch
+                entry[3] = now + phase.adjust(service_id, entry[2], wall) if phase.enabled else now
+                entry[5] = entry[4]
+                entry[4] = entry[3] + entry[2]
+                heapq.heappush(self.heap, (entry[4], service_id, entry[1]))
+        return (due, lags)
+
+    # defer()
+    #   Purpose: Reschedule services the dispatcher could not run (no capacity or no workers)
+    #            to be retried after a short delay instead of one interval later
+    #   Params:
+    #     - rows: array of deferred service rows
+    #     - delay: seconds until the retry
+    #   Returns: (none)
+    def defer(self, rows, delay):
+        with self.lock:
+            retry = time.monotonic() + delay
+            for row in rows:
+                entry = self.services.get(row[0])
+                if entry is None:
+                    continue
+                entry[1] += 1
+                # the check did not run, the database due time is authoritative again and the
+                #   check is still due since its original due time
+                entry[3] = None
+                entry[4] = entry[5]
+                heapq.heappush(self.heap, (retry, row[0], entry[1]))
+
+    # next_deadline()
+    #   Purpose: Return the monotonic time of the earliest live entry in the heap
+    #   Params: (none)
+    #   Returns: monotonic time, or None if nothing is scheduled
+    def next_deadline(self):
+        with self.lock:
+            while len(self.heap) > 0:
+                deadline, service_id, version = self.heap[0]
+                entry = self.services.get(service_id)
+                if entry is not None and entry[1] == version:
+                    return deadline
+                heapq.heappop(self.heap)
+        return None
+
+    # run()
+    #   Purpose: Dispatch due services at their deadline, refreshing changed rows every
+    #            refresh_interval and reloading the whole table every resync_interval
+    #   Params: (none)
+    #   Returns: (none)
+    def run(self):
+        print("Started deadline scheduler...")
+        while (True):
+            now = time.monotonic()
+            if cluster.enabled and cluster.owned()[1] != self.cluster_version:
+                # ownership changed, reload so services of buckets we gained or lost move
+                self.next_resync = now
+            if now >= self.next_resync:
+                self.load(True)
+                self.next_resync = now + self.resync_interval
+                self.next_refresh = now + self.refresh_interval
+            elif now >= self.next_refresh:
+                self.load(False)
+                self.next_refresh = now + self.refresh_interval
+
+            due, lags = self.pop_due()
+            if len(due) > 0:
+                deferred = self.dispatch(due, lags)
+                if deferred:
+                    self.defer(deferred, admission.retry_delay)
+
+            # sleep until the next deadline or the next refresh, whichever comes first
+            wake = self.next_refresh
+            deadline = self.next_deadline()
+            if deadline is not None and deadline < wake:
+                wake = deadline
+            delay = wake - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
@@ -0,0 +1,73 @@
+# settings.py
+# Author: Mason Rowe <mason@rowe.sh>
+# Project: pyPatrol-server
+# License: WTFPL <http://www.wtfpl.net/>
+# Last Updated: 18 Oct 2026
+#
+# Purpose: Loads pypatrol.conf once per process and shares it between the components.
+#          Sending SIGHUP to the process re-reads the file and hands the new config to every
+#          component that registered a reload hook
+
+import configparser, signal, threading
+
+# path of the config file, relative to the working directory
+path = 'pypatrol.conf'
+
+# the current pypatrol config, populated by load()
+config = None
+config_lock = threading.Lock()
+
+# functions called with the new config after a reload
+reload_hooks = []
+
+# read()
+#   Purpose: Parse the pypatrol config file
+#   Params: (none)
+#   Returns: ConfigParser holding the pypatrol config
+def read():
+    c = configparser.ConfigParser()
+    c.read(path)
+    return c
+
+# load()
+#   Purpose: Return the shared config, reading pypatrol.conf on first use only
+#   Params: (none)
+#   Returns: ConfigParser holding the pypatrol config
+def load():
+    global config
+    with config_lock:
+        if config is None:
+            config = read()
+        return config
+
+# on_reload()
+#   Purpose: Register a function to be called with the new config whenever it is reloaded
+#   Params:
+#     - hook: function taking the new ConfigParser
+#   Returns: (none)
+def on_reload(hook):
+    reload_hooks.append(hook)
+
+# reload()
+#   Purpose: Re-read pypatrol.conf and notify every registered component
+#   Params: (none)
+#   Returns: (none)
+def reload():
+    global config
+    with config_lock:
+        config = read()
+    print("settings.py: reload - reloaded pypatrol.conf")
+    for hook in reload_hooks:
+        try:
+            hook(config)
+        except Exception as error:
+            print(error)
+
+# install_sighup_handler()
+#   Purpose: Reload the config on SIGHUP. Signal handlers can only be installed from the main
+#            thread, so this is a no-op anywhere else
+#   Params: (none)
+#   Returns: (none)
+def install_sighup_handler():
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload())
@@ -4,13 +4,14 @@
 # License: WTFPL <http://www.wtfpl.net/>
 # Last Updated: 17 Oct 2018
 #
-# Purpose: Dispatches a single service check to three pyPatrol-node workers and checks
+# Purpose: Dispatches a single service check to several pyPatrol-node workers and checks
 #          the results for a status change. If a status change has occured, notify the
 #          user.
 
 from worker_mgr import Worker
+import alert_contacts, batcher, coalesce, consensus, db, history, metrics, notifier, payloads, settings
 from datetime import datetime
-import psycopg2, threading, requests, json, smtplib, configparser
+import threading, requests, json, queue, time, zmq
 
 # initialize config parser
 config = None
@@ -19,18 +20,17 @@ config = None
 db_poll_interval = 0
 http_timeout = 0
 
-# initialize database parameters
-db_host = ""
-db_port = 0
-db_database = ""
-db_user = ""
-db_pass = ""
+# per-worker results (latency and errors) waiting to be reported to the worker dispatcher
+worker_feedback = queue.Queue()
 
-# initialize smtp parameters
-smtp_server = ""
-smtp_port = 0
-smtp_user = ""
-smtp_pass = ""
+# (service, results, learn) of finished checks waiting for the consensus evaluator
+check_results = queue.Queue()
+
+worker_latency_metric = metrics.Histogram('pypatrol_worker_request_seconds', 'Service check request latency per pyPatrol-node worker', ('worker',))
+worker_errors_metric = metrics.Counter('pypatrol_worker_request_errors_total', 'Failed service check requests per pyPatrol-node worker', ('worker',))
+early_exit_metric = metrics.Counter('pypatrol_checks_early_exit_total', 'Checks decided before every worker answered')
+hedges_metric = metrics.Counter('pypatrol_hedged_requests_total', 'Requests re-sent to a spare worker because a worker was slow')
+transitions_metric = metrics.Counter('pypatrol_status_transitions_total', 'Service state transitions by kind', ('kind',))
 
 # notify_user()
 #   Purpose: A change in state of a service was detected, alert the user
@@ -40,83 +40,132 @@ smtp_pass = ""
 #   Returns: (none)
 def notify_user(service, new_status):
     cur_status = service[5] # current (previous) status of the service
-    conn = None
-    try:
-        conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM alert_contact WHERE user_id = %s" % service[1])
-        alert = cur.fetchone()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-
-    # found alert contact
-    if alert is not None:
-        # send alert email to user
-        server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        server.login(smtp_user, smtp_pass)
-        msg = "\nHello,\n\nYour service " + service[4] \
-            + " has been detected as " + new_status + " at " \
-            + service[9].strftime("%Y-%m-%d %H:%M:%S") + ".\n\n" + "Regards,\n-pyPatrol Team"
-        server.sendmail(smtp_user, alert[3], msg)
-
-        # update the status of the service to the new state
-        try:
-            conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-            cur = conn.cursor()
-            cur.execute("UPDATE service SET status = '%s', error_state = FALSE, status_change_time = NOW() WHERE id = %s" % (new_status, service[0]))
-            conn.commit()
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
-        finally:
-            if conn is not None:
-                conn.close()
+    contacts = alert_contacts.get(service[1])
+
+    # found alert contacts
+    if len(contacts) > 0:
+        # queue the alert for every contact, it is delivered (and coalesced with other alerts for
+        #   the same contact) by the notifier threads
+        notifier.notify(contacts, service[4], new_status, service[9])
+
+        # update the status of the service to the new state (written by the next bulk flush)
+        db.queue_service_update(service[0], status=new_status, error_state=False)
 
 # check_for_status_change()
-#   Purpose: Checks the results of a service check to see if the status state has changed.
-#            If the state has changed, then notify the user (notify_user())
+#   Purpose: Hands the results of a service check to the consensus evaluator thread, which
+#            decides the new status together with the other checks finishing at the same time
+#            and notifies the user if the state has changed (apply_status())
 #   Params:
 #     - service: service check details
-#     - results: array containing the results from a dispatched service check task (3 entries)
+#     - results: array containing the results from a dispatched service check task (one
+#                entry per worker)
+#     - learn: False for results of a probe shared with another service, so the workers'
+#              reliability is updated once per probe rather than once per service
 #   Returns: (none)
-def check_for_status_change(service, results):
-    # get the new service status, the status state must have consensus from at least two worker results
-    if (results[0]['status'] == results[1]['status'] or results[0]['status'] == results[2]['status']):
-        status = results[0]['status']
-    elif (results[1]['status'] == results[2]['status']):
-        status = results[1]['status']
-    else:
-        status = 'error'
+def check_for_status_change(service, results, learn=True):
+    check_results.put((service, results, learn))
 
+# apply_status()
+#   Purpose: Act on the status decided for a service check, updating the service and
+#            notifying the user if the state has changed
+#   Params:
+#     - service: service check details
+#     - status: status decided by the consensus engine ('error' without consensus)
+#   Returns: (none)
+def apply_status(service, status):
     cur_error_state = service[7]
     cur_status = service[5]
-    conn = None
-    try:
-        conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-        cur = conn.cursor()
-        if ((status == 'error' and cur_error_state) or (status == cur_status)):
-            # service already in error state or status has not changed, skip
-            return
-        elif (status == 'error' and not cur_error_state):
-            # service is now in an error state while not being in an error state previously
-            cur.execute("UPDATE service SET error_state = TRUE WHERE id = %s" % service[0])
-            conn.commit()
-            cur.close()
-        elif (status != cur_status):
-            # service status has changed, notify the user
-            notify_user(service, status)
-        elif (status == cur_status and cur_error_state):
-            # service is no longer in an error state
-            cur.execute("UPDATE service SET error_state = FALSE WHERE id = %s" % service[0])
-            conn.commit()
-            cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+    # state transitions are buffered and written in bulk by the db write buffer
+    if ((status == 'error' and cur_error_state) or (status == cur_status and not cur_error_state)):
+        # service already in error state or status has not changed, skip
+        return
+    elif (status == 'error' and not cur_error_state):
+        # service is now in an error state while not being in an error state previously
+        transitions_metric.inc(labels=('error',))
+        db.queue_service_update(service[0], error_state=True)
+    elif (status != cur_status):
+        # service status has changed, notify the user
+        transitions_metric.inc(labels=('status_change',))
+        notify_user(service, status)
+    elif (status == cur_status and cur_error_state):
+        # service is no longer in an error state
+        transitions_metric.inc(labels=('recovered',))
+        db.queue_service_update(service[0], error_state=False)
+
+# evaluate_results()
+#   Purpose: Consensus evaluator thread body, decides every check result queued since the last
+#            round as one batch
+#   Params: (none)
+#   Returns: (none)
+def evaluate_results():
+    print("Started evaluate_results thread...")
+    while (True):
+        batch = [check_results.get()]
+        while (not check_results.empty()):
+            batch.append(check_results.get_nowait())
+        try:
+            for service, results, status, state in consensus.evaluate(batch):
+                history.record(service[0], results, status)
+                apply_status(service, state)
+        except Exception as error:
+            print(error)
+
+# report_worker_result()
+#   Purpose: Queue a worker's response time and outcome for the worker dispatcher, which uses
+#            them to balance load across workers
+#   Params:
+#     - worker_uri: http endpoint the task was sent to
+#     - latency: seconds the worker took to answer
+#     - error: True if the request to the worker failed
+#   Returns: (none)
+def report_worker_result(worker_uri, latency, error):
+    # "http://ip:port/endpoint" -> "ip:port"
+    worker = worker_uri.split('/')[2]
+    worker_latency_metric.observe(latency, (worker,))
+    if error:
+        worker_errors_metric.inc(labels=(worker,))
+    worker_feedback.put({ 'worker': worker, 'latency': latency, 'error': error })
+
+# report_worker_event()
+#   Purpose: Queue a change to a worker's load that comes without a result: a request sent to a
+#            spare worker ('sent') or a request cancelled or never sent ('released')
+#   Params:
+#     - worker_uri: http endpoint (or base uri) of the pyPatrol-node worker
+#     - event: 'sent' or 'released'
+#   Returns: (none)
+def report_worker_event(worker_uri, event):
+    worker_feedback.put({ 'worker': worker_uri.split('/')[2], 'event': event })
+
+# release_workers()
+#   Purpose: Give back the load counted for the primary workers of a check that is answered
+#            without sending any request (coalesced with another service's probe)
+#   Params:
+#     - data: service check details
+#     - workers: array of pypatrol-node worker URIs, followed by any spare workers
+#   Returns: (none)
+def release_workers(data, workers):
+    for worker in workers[:consensus.workers_for(data)]:
+        report_worker_event(worker, 'released')
+
+# report_worker_feedback()
+#   Purpose: Periodically drain the per-worker results queued by the tasks and send them to
+#            the worker dispatcher in one message, using a dedicated DEALER socket since ZeroMQ
+#            sockets cannot be shared between threads
+#   Params: (none)
+#   Returns: (none)
+def report_worker_feedback():
+    print("Started report_worker_feedback thread...")
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.setsockopt(zmq.LINGER, 0)
+    dispatcher_host = config['workers']['dispatcher_host']
+    dispatcher_port = config['workers']['dispatcher_port']
+    socket.connect("tcp://" + dispatcher_host + ":" + dispatcher_port)
+    while (True):
+        feedback = [worker_feedback.get()]
+        while (not worker_feedback.empty()):
+            feedback.append(worker_feedback.get_nowait())
+        socket.send_multipart([b'', json.dumps({ 'feedback': feedback }).encode('utf-8')])
+        time.sleep(1)
 
 # execute_task()
 #   Purpose: Sends the pyPatrol service check request to the pyPatrol-node worker and
@@ -129,119 +178,196 @@ def check_for_status_change(service, results):
 #   Returns: (none)
 def execute_task(data, worker_uri, results, index):
     headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    start = time.monotonic()
     try:
         r = requests.post(worker_uri, data=json.dumps(data), headers=headers, timeout=http_timeout)
         results[index] = json.loads(r.text)
+        latency = time.monotonic() - start
+        report_worker_result(worker_uri, latency, False)
     except requests.exceptions.RequestException as e:
         print(e)
         err = { 'status': 'error' }
         results[index] = err
+        latency = time.monotonic() - start
+        report_worker_result(worker_uri, latency, True)
+    # kept with the result for the check history
+    results[index]['worker'] = worker_uri.split('/')[2]
+    results[index]['latency'] = latency
+
+# load_config()
+#   Purpose: Populate the task settings from the pypatrol config. Called once at startup by
+#            the task manager and again whenever the config is reloaded (SIGHUP)
+#   Params:
+#     - new_config: ConfigParser holding the pypatrol config, defaults to the shared config
+#   Returns: (none)
+def load_config(new_config=None):
+    global config
+    config = new_config if new_config is not None else settings.load()
+
+    # populate tasks settings
+    global db_poll_interval, http_timeout
+    db_poll_interval = int(config['tasks']['db_poll_interval'])
+    http_timeout = int(config['tasks']['http_timeout'])
+    payloads.configure(config)
+
+    # use the process-wide database connection pool (created by the task manager)
+    db.init(config)
+
+    # populate SMTP settings and start the notification pipeline
+    notifier.init(config)
+    alert_contacts.configure(config)
+
+    # check result history writer and consensus policy
+    history.init(config)
+    consensus.configure(config)
+
+    # batched requests to the pyPatrol-node workers and probe coalescing, if enabled
+    batcher.init(config)
+    coalesce.configure(config)
+
+# get_service_details()
+#   Purpose: Look up the pyPatrol-node endpoint and the data portion of the post request for
+#            a service check in the payload cache (prefetched in bulk by the task manager)
+#   Params:
+#     - data: service check details
+#   Returns: tuple of (endpoint url suffix, post data)
+def get_service_details(data):
+    payload = payloads.get(data)
+    if payload is None:
+        print("task.py: get_service_details - no check details for service %s" % data[0])
+        return ("", None)
+    return (payload.service_url, payload.post_data)
+
+# send_to_worker()
+#   Purpose: Thread body of a single worker request, hands the result to the orchestrating
+#            thread as (slot, result)
+#   Params:
+#     - data: service check post data
+#     - worker_uri: http endpoint to send the task to the pypatrol-node worker
+#     - slot: index of the result this request answers
+#     - answers: queue the result is put on
+#   Returns: (none)
+def send_to_worker(data, worker_uri, slot, answers):
+    result = [None]
+    execute_task(data, worker_uri, result, 0)
+    answers.put((slot, result[0]))
+
+# dispatch_request()
+#   Purpose: Send one worker request of a check, through the node's batch when batching is
+#            enabled and in its own thread otherwise
+#   Params:
+#     - data: service check post data
+#     - worker: base uri of the pyPatrol-node worker
+#     - service_url: endpoint url suffix of the check
+#     - slot: index of the result this request answers
+#     - answers: queue the (slot, result) is put on
+#   Returns: (none)
+def dispatch_request(data, worker, service_url, slot, answers):
+    if batcher.enabled:
+        batcher.submit(worker, service_url, data, lambda result: answers.put((slot, result)))
+        return
+    t = threading.Thread(target=send_to_worker, args=(data, worker + service_url, slot, answers))
+    t.setDaemon(True)
+    t.start()
+
+# collect()
+#   Purpose: Send a check to its primary workers and gather results until the vote is
+#            settled, hedging requests still outstanding after hedge_delay on the spares
+#   Params:
+#     - data: service check details
+#     - post_data: service check post data
+#     - service_url: endpoint url suffix of the check
+#     - workers: array of pypatrol-node worker URIs, followed by any spare workers
+#   Returns: array with one result (or None) per primary worker
+def collect(data, post_data, service_url, workers):
+    n = min(consensus.workers_for(data), len(workers))
+    primaries = workers[:n]
+    spares = workers[n:]
+
+    # one result slot per primary worker, filled by whichever request for it answers first
+    results = [None] * n
+    answers = queue.Queue()
+
+    # send the service check to each of the workers, stragglers are left to finish on their
+    #   own once the check is decided
+    for i in range(n):
+        dispatch_request(post_data, primaries[i], service_url, i, answers)
+
+    now = time.monotonic()
+    deadline = now + http_timeout + batcher.batch_window + 1
+    hedge_at = now + consensus.hedge_delay if len(spares) > 0 and consensus.hedge_delay > 0 else None
+    filled = 0
+    while (filled < n):
+        now = time.monotonic()
+        wait = deadline - now
+        if hedge_at is not None:
+            wait = min(wait, hedge_at - now)
+        try:
+            slot, result = answers.get(timeout=max(wait, 0))
+        except queue.Empty:
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                # hedge the slowest requests on the spare workers
+                for i in range(n):
+                    if results[i] is None and len(spares) > 0:
+                        spare = spares.pop(0)
+                        report_worker_event(spare, 'sent')
+                        dispatch_request(post_data, spare, service_url, i, answers)
+                        hedges_metric.inc()
+                hedge_at = None
+                continue
+            if time.monotonic() >= deadline:
+                break
+            continue
+        if results[slot] is not None:
+            continue # the other request for this slot answered first
+        results[slot] = result
+        filled += 1
+        outstanding = [primaries[i].split('/')[2] for i in range(n) if results[i] is None]
+        if len(outstanding) > 0 and consensus.settled(results, outstanding):
+            early_exit_metric.inc()
+            break
+
+    return results
 
 # orchestrate()
-#   Purpose: Orchestrates the dispersing of the service check task to the three workers,
-#            collects the status results, and calls to see if the status has changed
+#   Purpose: Orchestrates the dispersing of the service check task to the workers,
+#            collects the status results, and calls to see if the status has changed. Stops
+#            waiting as soon as the results received settle the vote, and after hedge_delay
+#            re-sends the requests still outstanding to spare workers (first answer wins).
+#            Services probing the same target share one probe (coalesce.py)
 #   Params:
 #     - data: service check details
-#     - workers: array of three pypatrol-node worker URIs
+#     - workers: array of pypatrol-node worker URIs (consensus.fanout of them by default,
+#                followed by any spare workers)
 #   Returns: (none)
 def orchestrate(data, workers):
     # if for some reason no worker URIs were given, exit
     if workers is None:
         return
 
-    # read pypatrol config
-    global config
-    config = configparser.ConfigParser()
-    config.read('pypatrol.conf')
+    service_url, post_data = get_service_details(data)
 
-    # populate tasks settings
-    global db_poll_interval, http_timeout
-    db_poll_interval = int(config['tasks']['db_poll_interval'])
-    http_timeout = int(config['tasks']['http_timeout'])
+    # share the probe with other services checking the same target
+    probe = coalesce.key(service_url, post_data, consensus.workers_for(data))
+    if probe is not None:
+        role, results = coalesce.join(probe, data)
+        if role == 'cached':
+            check_for_status_change(data, results, False)
+        if role != 'leader':
+            release_workers(data, workers)
+            return
 
-    # populate PSQL settings
-    global db_host, db_port, db_database, db_user, db_pass
-    db_host = config['database']['host']
-    db_port = int(config['database']['port'])
-    db_database = config['database']['database']
-    db_user = config['database']['user']
-    db_pass = config['database']['password']
-
-    # populate SMTP settings
-    global smtp_server, smtp_port, smtp_user, smtp_pass
-    smtp_server = config['mail']['smtp_server']
-    smtp_port = int(config['mail']['smtp_port'])
-    smtp_user = config['mail']['smtp_user']
-    smtp_pass = config['mail']['smtp_password']
-
-    conn = None
-    service_id = None
-    service_type = None
-    service_url = ""
-    post_data = None
-    # determine which service check type the service corresponds to and populate the revelant details
-    #   in the data portion of the post request
     try:
-        conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-        cur = conn.cursor()
-        service_id = data[0]
-        service_type = data[3]
-        # ip_port_service service check type
-        if (service_type in {1, 2, 5, 6}):
-            cur.execute("SELECT * FROM ip_port_service WHERE ip_port_service.service_id = %s" % service_id)
-            service = cur.fetchone()
-            if (service_type == 1): service_url = "/ping"
-            elif (service_type == 2): service_url = "/ping6"
-            elif (service_type == 5): service_url = "/tcp_socket"
-            elif (service_type == 6): service_url = "/steam_server"
-
-            port = service[3] if service[3] is not None else ""
-            post_data = {
-                'ip': service[2],
-                'port': port
-            }
-            cur.close()
-        # http_service service check type
-        elif (service_type == 3):
-            cur.execute("SELECT * FROM http_service WHERE http_service.service_id = %s" % service_id)
-            service = cur.fetchone()
-            service_url = "/http_response"
-            post_data = {
-                'hostname': service[2],
-                'redirects': service[3],
-                'check_string': service[4],
-                'keywords': service[5]
-            }
-            cur.close()
-        # cert_service service check type
-        elif (service_type == 4):
-            cur.execute("SELECT * FROM cert_service WHERE cert_service.service_id = %s" % service_id)
-            service = cur.fetchone()
-            service_url = "/cert"
-            post_data = {
-                'hostname': service[2],
-                'buffer': int(service[3])
-            }
-            cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-
-    # initialize the threads and results array for the service checks
-    threads = [None] * 3
-    results = [None] * 3
-
-    # create a new thread to send the service check to each of the three workers
-    for i in range(len(workers)):
-        worker_uri = workers[i] + service_url
-        threads[i] = threading.Thread(target=execute_task, args=(post_data, worker_uri, results, i))
-        threads[i].start()
-
-    # wait until all three threads return, results are stored in the results array
-    for i in range(len(threads)):
-        threads[i].join()
-
-    # determine if a status change has occured and if so, notify the user
+        results = collect(data, post_data, service_url, workers)
+    except BaseException:
+        # release the services waiting on this probe, they are retried next period
+        if probe is not None:
+            coalesce.finish(probe, [])
+        raise
+
+    # determine if a status change has occured and if so, notify the user (of every service
+    #   that shared the probe)
     check_for_status_change(data, results)
+    if probe is not None:
+        for service in coalesce.finish(probe, results):
+            check_for_status_change(service, results, False)
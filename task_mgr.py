@@ -8,18 +8,100 @@
 #          check the database for expired service checks. If any checks need to be executed,
 #          each check is placed within its own task in a non-blocking thread
 
-import task, worker_mgr
-import psycopg2, time, zmq, threading, configparser
+import task, worker_mgr, scheduler, db, payloads, settings, alert_contacts, cluster, admission, metrics, history, consensus, phase
+from datetime import datetime
+import psycopg2, psycopg2.extras, time, zmq, threading, json
 
 # initialize config parser
 config = None
 
-# initialize database parameters
-db_host = ""
-db_port = 0
-db_database = ""
-db_user = ""
-db_pass = ""
+# columns of a service row that checks read, at the positions the rest of the server indexes
+#   a service row by (ids and type for dispatch, name for alerts, status/error_state for
+#   consensus, interval and last_check_time for claims and alerts, updated_at for the payload
+#   cache). active, status_desc and status_change_time are never read, NULL keeps their slots
+#   so rows stay index compatible with SELECT * rows (deadline scheduler) and executors are
+#   not sent the unused values. An index covering these columns would still be most of the
+#   row, so service_due_idx only carries the due time and id
+SERVICE_COLUMNS = "service.id, service.user_id, NULL, service.type, service.name, service.status, " \
+    "NULL, service.error_state, service.interval, service.last_check_time, " \
+    "NULL, service.updated_at"
+
+# time a service is due, must match the service_due_idx expression index in test.sql
+DUE_SQL = "(service.last_check_time + (service.interval * interval '1 sec'))"
+
+# seconds a service is overdue, computed by the database like the scheduler's due times
+LAG_SQL = "EXTRACT(EPOCH FROM (NOW() - " + DUE_SQL + "))"
+
+# asyncio check engine, None when checks run in their own threads
+check_engine = None
+
+# multi-process mode: ZeroMQ PUSH socket fanning due tasks out to the executor processes,
+#   None when checks run inside this process
+executor_socket = None
+
+# long-lived ZeroMQ DEALER socket to the worker dispatcher, created on first use
+zmq_context = None
+dispatcher_socket = None
+dispatcher_request_id = 0
+
+poll_duration_metric = metrics.Histogram('pypatrol_poll_duration_seconds', 'Duration of the due service check query')
+poll_rows_metric = metrics.Histogram('pypatrol_poll_rows', 'Due service rows returned per poll',
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000))
+dispatcher_latency_metric = metrics.Histogram('pypatrol_dispatcher_request_seconds', 'Round trip time of worker dispatcher batch requests')
+dispatcher_timeouts_metric = metrics.Counter('pypatrol_dispatcher_timeouts_total', 'Worker dispatcher batch requests that timed out')
+
+# request_workers()
+#   Purpose: Ask the worker manager for the workers of every task in a single round trip
+#            over the long-lived DEALER socket
+#   Params:
+#     - types: array of 'ipv4'/'ipv6' worker types, one per task
+#     - fanout: array of the number of workers wanted, one per task
+#   Returns: array with the worker URIs (or None) per requested type, followed by up to
+#            consensus.spare_workers spare URIs for hedged requests
+def request_workers(types, fanout):
+    global zmq_context, dispatcher_socket, dispatcher_request_id
+    if dispatcher_socket is None:
+        if zmq_context is None:
+            zmq_context = zmq.Context()
+        dispatcher_socket = zmq_context.socket(zmq.DEALER)
+        dispatcher_socket.setsockopt(zmq.LINGER, 0)
+        dispatcher_host = config['workers']['dispatcher_host']
+        dispatcher_port = config['workers']['dispatcher_port']
+        dispatcher_socket.connect("tcp://" + dispatcher_host + ":" + dispatcher_port)
+
+    dispatcher_request_id += 1
+    start = time.monotonic()
+    msg = { 'id': dispatcher_request_id, 'batch': types, 'fanout': fanout, 'spares': consensus.spare_workers }
+    dispatcher_socket.send_multipart([b'', json.dumps(msg).encode('utf-8')])
+
+    # wait for the matching reply, discarding late replies to earlier timed out requests
+    timeout = float(config['workers'].get('dispatcher_timeout', '5')) * 1000
+    while (dispatcher_socket.poll(timeout) != 0):
+        reply = json.loads(dispatcher_socket.recv_multipart()[-1])
+        if reply['id'] == dispatcher_request_id:
+            dispatcher_latency_metric.observe(time.monotonic() - start)
+            return reply['batch']
+    dispatcher_timeouts_metric.inc()
+    print("task_mgr.py: request_workers - worker dispatcher did not answer, dropping %s tasks" % len(types))
+    # start over with a fresh socket next time
+    dispatcher_socket.close()
+    dispatcher_socket = None
+    return [None] * len(types)
+
+# release_workers()
+#   Purpose: Give back the load the worker dispatcher counted for allocations that were never
+#            dispatched, as worker feedback over the dispatcher socket (not answered). Anything
+#            not released here expires after the dispatcher's load_lease
+#   Params:
+#     - jobs: array of (task, workers) tuples that were not dispatched
+#   Returns: (none)
+def release_workers(jobs):
+    if dispatcher_socket is None or len(jobs) == 0:
+        return
+    # only the primary workers of a check count against the load, not its spares
+    feedback = [{ 'worker': uri.split('/')[2], 'event': 'released' }
+        for task, workers in jobs for uri in workers[:consensus.workers_for(task)]]
+    dispatcher_socket.send_multipart([b'', json.dumps({ 'feedback': feedback }).encode('utf-8')])
 
 # send_task()
 #   Purpose: Helper method to be able to spawn a task in a new thread
@@ -28,90 +110,316 @@ db_pass = ""
 #     - workers: array containing pyPatrol-node worker URI's for task dispatch
 #   Returns: (none)
 def send_task(data, workers):
-    task.orchestrate(data, workers)
+    try:
+        task.orchestrate(data, workers)
+    finally:
+        admission.release()
+
+# run_task()
+#   Purpose: Start a service check in this process, on the asyncio engine if enabled or in
+#            its own thread otherwise
+#   Params:
+#     - data: service check details required for a pyPatrol-node worker
+#     - workers: array containing pyPatrol-node worker URI's for task dispatch
+#   Returns: (none)
+def run_task(data, workers):
+    admission.acquire()
+    if check_engine is not None:
+        # hand the task to the asyncio check engine
+        check_engine.submit(data, workers).add_done_callback(lambda f: admission.release())
+    else:
+        # spawn task thread
+        t = threading.Thread(target=send_task, args=(data, workers))
+        t.start()
+
+# encode_jobs()
+#   Purpose: Serialize a batch of (task, workers) jobs for the executor processes. JSON rather
+#            than pickle so that a peer on the executor port cannot run code in an executor;
+#            the timestamps of the service rows are tagged to come back as datetimes
+#   Params:
+#     - jobs: array of (task, workers) tuples
+#   Returns: bytes
+def encode_jobs(jobs):
+    return json.dumps(jobs, default=lambda v: { '__datetime__': v.isoformat() } if isinstance(v, datetime) else str(v)).encode('utf-8')
+
+# decode_jobs()
+#   Purpose: Deserialize a batch of jobs encoded by encode_jobs()
+#   Params:
+#     - message: bytes
+#   Returns: array of (task, workers) tuples
+def decode_jobs(message):
+    jobs = json.loads(message, object_hook=lambda d: datetime.fromisoformat(d['__datetime__']) if '__datetime__' in d else d)
+    return [(tuple(task), workers) for task, workers in jobs]
+
+# send_to_executors()
+#   Purpose: Hand (task, workers) jobs to the executor processes in batches without blocking.
+#            Once the executors' queues are full the remaining jobs are given back. PUSH has
+#            no acknowledgement: batches still queued (in this socket or an executor's receive
+#            queue) when an executor dies are lost, and since their services were already
+#            stamped as checked they are only checked again one interval later
+#   Params:
+#     - jobs: array of (task, workers) tuples, most overdue first
+#   Returns: number of jobs sent
+def send_to_executors(jobs):
+    batch_size = int(config['tasks'].get('executor_batch_size', '100'))
+    for i in range(0, len(jobs), batch_size):
+        try:
+            executor_socket.send(encode_jobs(jobs[i:i + batch_size]), zmq.NOBLOCK)
+        except zmq.Again:
+            return i
+    return len(jobs)
 
 # process_tasks()
 #   Purpose: Takes an array of tasks whose last check time > check interval and spawns
-#            each task to be processed in its own thread. Also updates last check time
+#            each task to be processed in its own thread. Also updates last check time (in
+#            cluster mode, only the tasks this instance managed to claim are processed).
+#            Tasks are admitted most overdue first up to max_in_flight; tasks that do not fit
+#            or get no workers keep their last check time and are handed back
 #   Params:
 #     - tasks: array of tasks which require a new updated service check
-#   Returns: (none)
-def process_tasks(tasks):
-    conn = None
-    context = None
+#     - lags: array of seconds each task is overdue
+#   Returns: array of tasks deferred to a later dispatch
+def process_tasks(tasks, lags):
+    admitted, deferred = admission.prioritize(tasks, lags)
+    if len(admitted) == 0:
+        admission.record([], 0, 0, len(deferred))
+        return deferred
+    tasks = [e[0] for e in admitted]
+    lags = dict((e[0][0], e[1]) for e in admitted)
+    no_workers = []
+    backpressure = []
+    dispatched = set() # ids of the tasks handed to a check thread or an executor
     try:
-        conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-        cur = conn.cursor()
-        # initialize zeromq request message to obtain three workers from the worker manger
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        dispatcher_host = config['workers']['dispatcher_host']
-        dispatcher_port = config['workers']['dispatcher_port']
-        socket.connect("tcp://" + dispatcher_host + ":" + dispatcher_port)
-        # get workers for each service check task and send each task to its own thread
-        for task in tasks:
-            type = 'ipv6' if int(task[3]) == 2 else 'ipv4' # ipv6 if ping6 task, otherwise ipv4
-            msg = { 'request' : type }
-            socket.send_json(msg)
-            # worker manager returns three workers
-            reply = socket.recv_json()
-            # spawn task thread
-            t = threading.Thread(target=send_task, args=(task, reply))
-            t.start()
-            # update last check time in the database for that service check
-            cur.execute("UPDATE service SET last_check_time = NOW() WHERE id = %s" % task[0])
-        print("Updating %s rows" % len(tasks))
-        conn.commit()
-        cur.close()
+        with db.connection() as conn:
+            cur = conn.cursor()
+            if cluster.enabled:
+                # claim the due services first so that an instance with a stale view of the
+                #   cluster cannot dispatch them again in the same period
+                cur.execute("UPDATE service SET last_check_time = " + phase.stamp_sql() + " WHERE id = ANY(%s) " \
+                    "AND NOW() + (%s * interval '1 sec') >= (service.last_check_time + (service.interval * interval '1 sec')) RETURNING id",
+                    ([task[0] for task in tasks], cluster.claim_tolerance))
+                claimed = set(row[0] for row in cur.fetchall())
+                conn.commit()
+                tasks = [task for task in tasks if task[0] in claimed]
+                if len(tasks) == 0:
+                    return deferred
+            # obtain the workers for every task from the worker manager in one batch request,
+            #   ipv6 if ping6 task, otherwise ipv4 (three per task unless configured otherwise)
+            types = ['ipv6' if int(task[3]) == 2 else 'ipv4' for task in tasks]
+            replies = request_workers(types, [consensus.workers_for(task) for task in tasks])
+            # tasks without workers are retried instead of being stamped as checked
+            jobs = [(task, reply) for task, reply in zip(tasks, replies) if reply is not None]
+            no_workers = [task for task, reply in zip(tasks, replies) if reply is None]
+            if executor_socket is not None:
+                # multi-process mode, executors pull the tasks in batches (round robin)
+                sent = send_to_executors(jobs)
+                backpressure = [job[0] for job in jobs[sent:]]
+                release_workers(jobs[sent:])
+                jobs = jobs[:sent]
+                dispatched.update(job[0][0] for job in jobs)
+            else:
+                # load the check details of the whole poll in one query before dispatching
+                payloads.prefetch([job[0] for job in jobs])
+                # send each task to its own thread
+                for task, reply in jobs:
+                    run_task(task, reply)
+                    dispatched.add(task[0])
+            if not cluster.enabled:
+                # update last check time in the database for every dispatched service check at once
+                #   (on the service's phase grid when phase spreading is enabled)
+                cur.execute("UPDATE service SET last_check_time = " + phase.stamp_sql() + " WHERE id = ANY(%s)", ([job[0][0] for job in jobs],))
+            elif len(no_workers) + len(backpressure) > 0:
+                # give back the claims of the tasks that were not dispatched
+                psycopg2.extras.execute_values(cur,
+                    "UPDATE service SET last_check_time = v.last_check_time " \
+                    "FROM (VALUES %s) AS v(id, last_check_time) WHERE service.id = v.id",
+                    [(task[0], task[9]) for task in no_workers + backpressure], template="(%s::int, %s::timestamp)")
+            print("Updating %s rows" % len(jobs))
+            conn.commit()
+            cur.close()
+            admission.record([lags[job[0][0]] for job in jobs], len(no_workers), len(backpressure),
+                len(deferred) + len(no_workers) + len(backpressure))
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+        # hand back every admitted task that was not dispatched (e.g. the database was briefly
+        #   unreachable) so the deadline scheduler retries it instead of skipping an interval
+        return deferred + [task for task in tasks if task[0] not in dispatched]
+    return deferred + no_workers + backpressure
+
+# reload_config()
+#   Purpose: Settings reload hook, picks up the new pypatrol config in the task manager and
+#            in the tasks
+#   Params:
+#     - new_config: ConfigParser holding the reloaded pypatrol config
+#   Returns: (none)
+def reload_config(new_config):
+    global config
+    config = new_config
+    task.load_config(new_config)
+    admission.configure(new_config)
+    phase.configure(new_config)
+    alert_contacts.load_all()
 
 # check_for_new_tasks()
 #   Purpose: Poll the database, check if any service checks need to be re-executed (when
-#   the last_check_time > check interval), and dispatch these checks as tasks
+#   the last_check_time > check interval), and dispatch these checks as tasks. Due services
+#   are streamed most overdue first through a server-side cursor and dispatched chunk by
+#   chunk, so a large backlog never has to fit in memory before the first check starts
 #   Params: (none)
 #   Returns: (none)
 def check_for_new_tasks():
-    conn = None
+    rows = 0
+    start = time.monotonic()
+    chunk_size = int(config['tasks'].get('poll_chunk_size', '1000'))
+    where = ""
+    params = ()
+    if cluster.enabled:
+        # only poll the buckets of the service table owned by this instance
+        buckets, version = cluster.owned()
+        where = " AND (service.id %% %s) = ANY(%s)"
+        params = (cluster.BUCKETS, buckets)
     try:
-        conn = psycopg2.connect(host=db_host, port=db_port, database=db_database, user=db_user, password=db_pass)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM service WHERE NOW() >= (service.last_check_time + (service.interval * interval '1 sec'))")
-        rows = cur.fetchall()
-        # process any service checks that need to be executed
-        if len(rows) > 0:
-            process_tasks(rows)
-        cur.close()
+        # the cursor gets a connection of its own since process_tasks() commits on the
+        #   thread's connection, which would close a cursor opened on it
+        with db.dedicated_connection() as conn:
+            cur = conn.cursor(name='due_services')
+            cur.itersize = chunk_size
+            cur.execute("SELECT " + SERVICE_COLUMNS + ", " + LAG_SQL + " FROM service WHERE " + DUE_SQL + " <= NOW()" + where \
+                + " ORDER BY " + DUE_SQL, params)
+            while (True):
+                chunk = cur.fetchmany(chunk_size)
+                if len(chunk) == 0:
+                    break
+                rows += len(chunk)
+                # the lag column is split off the service rows
+                process_tasks([row[:-1] for row in chunk], [float(row[-1]) for row in chunk])
+                if admission.in_flight >= admission.max_in_flight:
+                    # the rest would only be deferred, leave it for the next poll
+                    break
+            cur.close()
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+    poll_duration_metric.observe(time.monotonic() - start)
+    poll_rows_metric.observe(rows)
+
+# start_check_runtime()
+#   Purpose: Start what a process running service checks needs: the worker feedback reporter
+#            and, if configured, the asyncio check engine
+#   Params: (none)
+#   Returns: (none)
+def start_check_runtime():
+    # report worker latency and errors back to the worker dispatcher for load balancing
+    f = threading.Thread(target=task.report_worker_feedback, name='report_worker_feedback')
+    f.setDaemon(True)
+    f.start()
+
+    # decide the status of finished checks in batches
+    e = threading.Thread(target=task.evaluate_results, name='evaluate_results')
+    e.setDaemon(True)
+    e.start()
+
+    # asyncio engine runs every check as a coroutine on one event loop, thread mode (the
+    #   default) spawns a thread per check and per worker request
+    if config['tasks'].get('engine', 'thread') == 'asyncio':
+        import engine
+        global check_engine
+        max_concurrent_checks = int(config['tasks'].get('max_concurrent_checks', '500'))
+        node_connections = int(config['tasks'].get('node_connections', '10'))
+        blocking_threads = int(config['database'].get('pool_max_size', '10'))
+        check_engine = engine.CheckEngine(max_concurrent_checks, node_connections, blocking_threads)
+        check_engine.start()
+
+# executor_main()
+#   Purpose: Entry point of a check executor process in multi-process mode. Pulls batches of
+#            (task, workers) from the scheduler process and runs the checks
+#   Params:
+#     - index: number of the executor process, picks its /metrics port
+#   Returns: (none)
+def executor_main(index=0):
+    print('Started task executor...')
+
+    global config
+    config = settings.load()
+    settings.on_reload(reload_config)
+    settings.install_sighup_handler()
+
+    db.init(config)
+    task.load_config(config)
+    admission.configure(config)
+    alert_contacts.load_all()
+    start_check_runtime()
+    metrics.init(config, 2 + index, run_reactor=True)
+
+    socket = zmq.Context.instance().socket(zmq.PULL)
+    # bound the batches queued for this executor (set before connecting, ZeroMQ only applies
+    #   it to later connections) so a saturated executor's share stays queued at the scheduler
+    #   and the scheduler sees backpressure. ZeroMQ still prefetches up to executor_queue_size
+    #   batches regardless of capacity, and a batch is started whole once any slot is free, so
+    #   in_flight can exceed max_in_flight by up to executor_batch_size - 1 checks
+    socket.setsockopt(zmq.RCVHWM, int(config['tasks'].get('executor_queue_size', '10')))
+    socket.connect("tcp://" + config['tasks'].get('executor_host', '127.0.0.1') + ":" \
+        + config['tasks'].get('executor_port', '12348'))
+    while (True):
+        admission.wait_for_capacity()
+        jobs = decode_jobs(socket.recv())
+        # load the check details of the whole batch in one query before dispatching
+        payloads.prefetch([job[0] for job in jobs])
+        for data, workers in jobs:
+            run_task(data, workers)
 
 # main()
 #   Purpose: Continuously check the database for expired service checks
-#   Params: (none)
+#   Params:
+#     - distributed: True to hand due checks to executor processes instead of running them
 #   Returns: (none)
-def main():
+def main(distributed=False):
     print('Started task_manager.py...')
 
-    # read pypatrol config
+    # read pypatrol config once, tasks re-read their settings only on reload (SIGHUP)
     global config
-    config = configparser.ConfigParser()
-    config.read('pypatrol.conf')
+    config = settings.load()
+    settings.on_reload(reload_config)
+    settings.install_sighup_handler()
+
+    # initialize the process-wide database connection pool
+    db.init(config)
+    task.load_config(config)
+    admission.configure(config)
+    phase.configure(config)
+    # warm the alert contact cache so notifications need no database round trips
+    alert_contacts.load_all()
 
-    global db_host, db_port, db_database, db_user, db_pass
-    db_host = config['database']['host']
-    db_port = int(config['database']['port'])
-    db_database = config['database']['database']
-    db_user = config['database']['user']
-    db_pass = config['database']['password']
+    # join the other pyPatrol-server instances sharing the service table, if configured
+    cluster.init(config)
+
+    # check_result partitions, retention and rollups
+    history.start_maintenance()
 
     interval = int(config['tasks']['db_poll_interval'])
 
+    if distributed:
+        # checks run in separate executor processes (see executor_main())
+        global executor_socket
+        executor_socket = zmq.Context.instance().socket(zmq.PUSH)
+        # bounded queue of batches per executor, a full queue defers the remaining due checks.
+        #   Binds to the loopback interface unless executor_host says otherwise
+        executor_socket.setsockopt(zmq.SNDHWM, int(config['tasks'].get('executor_queue_size', '10')))
+        executor_socket.bind("tcp://" + config['tasks'].get('executor_host', '127.0.0.1') + ":" \
+            + config['tasks'].get('executor_port', '12348'))
+        # /metrics of this process, next to the worker manager process' port
+        metrics.init(config, 1, run_reactor=True)
+    else:
+        start_check_runtime()
+
+    # deadline mode keeps the service table in memory and dispatches each check on time,
+    #   poll mode (the default) scans the service table every db_poll_interval seconds
+    if config['tasks'].get('scheduler', 'poll') == 'deadline':
+        refresh_interval = int(config['tasks'].get('scheduler_refresh_interval', str(interval)))
+        resync_interval = int(config['tasks'].get('scheduler_resync_interval', '300'))
+        s = scheduler.DeadlineScheduler(process_tasks, refresh_interval, resync_interval)
+        s.run()
+        return
+
     while (True):
         check_for_new_tasks()
         time.sleep(interval)
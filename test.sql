@@ -52,6 +52,37 @@ CREATE TABLE http_service (
 INSERT INTO http_service (id, service_id, hostname, redirects, check_string, keywords)
 VALUES (1, 3, 'https://www.google.com', FALSE, FALSE, NULL);
 
+-- Table: check_result (raw worker results of every check, one partition per day; partitions
+-- are created ahead and dropped after retention_days by history.py)
+CREATE TABLE check_result (
+    checked_at timestamp  NOT NULL,
+    cert_expiry timestamp  NULL,
+    service_id int  NOT NULL,
+    latency real  NULL,
+    response_code smallint  NULL,
+    agrees boolean  NOT NULL,
+    up boolean  NOT NULL,
+    worker text  NOT NULL,
+    status text  NOT NULL
+) PARTITION BY RANGE (checked_at);
+
+CREATE TABLE check_result_default PARTITION OF check_result DEFAULT;
+
+CREATE INDEX check_result_service_idx ON check_result (service_id, checked_at);
+
+-- Table: check_rollup (per service, per hour summary of check_result)
+CREATE TABLE check_rollup (
+    service_id int  NOT NULL,
+    hour timestamp  NOT NULL,
+    results int  NOT NULL,
+    uptime real  NULL,
+    latency_p50 real  NULL,
+    latency_p95 real  NULL,
+    latency_p99 real  NULL,
+    disagreements int  NOT NULL,
+    CONSTRAINT check_rollup_pk PRIMARY KEY (service_id, hour)
+);
+
 -- Table: ip_port_service
 CREATE TABLE ip_port_service (
     id SERIAL PRIMARY KEY,
@@ -80,10 +111,57 @@ CREATE TABLE service (
     error_state boolean NOT NULL,
     interval int NOT NULL,
     last_check_time timestamp  NOT NULL,
-    status_change_time timestamp  NOT NULL
+    status_change_time timestamp  NOT NULL,
+    updated_at timestamp  NOT NULL DEFAULT NOW()
     --CONSTRAINT service_pk PRIMARY KEY (id)
 );
 
+CREATE INDEX service_updated_at_idx ON service (updated_at);
+
+-- Due time of each service, lets the task manager stream due services most overdue first with
+-- an ordered range scan (see task_mgr.DUE_SQL)
+CREATE INDEX service_due_idx ON service ((last_check_time + ("interval" * interval '1 sec')), id);
+
+-- Bucket of each service for multi-instance ownership (see cluster.BUCKETS)
+CREATE INDEX service_bucket_idx ON service ((id % 1024));
+
+-- Stamp updated_at on every change except the routine last_check_time bump, so the deadline
+-- scheduler only re-reads rows that actually changed
+CREATE FUNCTION service_set_updated_at() RETURNS trigger AS $$
+BEGIN
+    IF (NEW.user_id, NEW.active, NEW.type, NEW.name, NEW.status, NEW.status_desc, NEW.error_state, NEW.interval, NEW.status_change_time)
+        IS DISTINCT FROM
+       (OLD.user_id, OLD.active, OLD.type, OLD.name, OLD.status, OLD.status_desc, OLD.error_state, OLD.interval, OLD.status_change_time) THEN
+        NEW.updated_at := NOW();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER service_updated_at BEFORE UPDATE ON service
+    FOR EACH ROW EXECUTE PROCEDURE service_set_updated_at();
+
+-- Changes to a service's check details bump service.updated_at so cached check payloads are
+-- refetched
+CREATE FUNCTION service_details_touch() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE service SET updated_at = NOW() WHERE id = OLD.service_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE service SET updated_at = NOW() WHERE id = NEW.service_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER ip_port_service_touch AFTER INSERT OR UPDATE OR DELETE ON ip_port_service
+    FOR EACH ROW EXECUTE PROCEDURE service_details_touch();
+CREATE TRIGGER http_service_touch AFTER INSERT OR UPDATE OR DELETE ON http_service
+    FOR EACH ROW EXECUTE PROCEDURE service_details_touch();
+CREATE TRIGGER cert_service_touch AFTER INSERT OR UPDATE OR DELETE ON cert_service
+    FOR EACH ROW EXECUTE PROCEDURE service_details_touch();
+
 INSERT INTO service (user_id, active, type, name, status, status_desc, error_state, interval, last_check_time, status_change_time)
 VALUES
   (1, TRUE, 1, 'PING TEST', 'offline', NULL, FALSE, 60, NOW(), NOW()),
@@ -93,6 +171,13 @@ VALUES
   (1, TRUE, 5, 'TCP TEST', 'online', NULL, FALSE, 60, NOW(), NOW()),
   (1, TRUE, 6, 'STEAM TEST', 'online', NULL, FALSE, 60, NOW(), NOW());
 
+-- Table: scheduler_instance (live pyPatrol-server instances and their heartbeat leases)
+CREATE TABLE scheduler_instance (
+    id text  NOT NULL,
+    heartbeat timestamp  NOT NULL,
+    CONSTRAINT scheduler_instance_pk PRIMARY KEY (id)
+);
+
 -- Table: service_types
 CREATE TABLE service_types (
     id int  NOT NULL,
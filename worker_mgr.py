@@ -5,22 +5,33 @@
 # Last Updated: 15 Oct 2018
 #
 # Purpose: Manages pyPatrol-node workers by maintaining a list currently active workers
-#          that have registered with the server (via the Twisted endpoint), regularaly
-#          polls the worker array to remove inactive workers, and responds to requests
-#          from task threads with worker details to carry out the service check
+#          that have registered with the server (via the Twisted endpoint), expires workers
+#          that stop sending heartbeats, and responds to requests from task threads with
+#          worker details to carry out the service check. The registry is snapshotted to disk
+#          so a restarted server can dispatch to the known workers straight away
 
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from datetime import datetime
-import json, random, threading, time, zmq, configparser, requests
+import metrics, settings
+import codecs, collections, json, os, random, threading, time, zmq, requests, heapq
 
-workers = []
 secrets = [] # secret key(s) that a worker must present to the server
-workers_lock = threading.Lock() # lock to protect the workers array
 
 # initialize config parser
 config = None
 
+# worker selection strategy: 'uniform', 'weighted' (by measured latency and current load),
+#   'p2c' (power of two choices on load/latency/errors) or 'least_loaded'
+selection = 'uniform'
+region_diversity = False # prefer workers from distinct regions for a single check
+ewma_alpha = 0.2 # smoothing factor for the latency and error rate averages
+load_lease = 60.0 # seconds a check counts against a worker's load if its result is never reported
+inactivity_timeout = 45.0 # seconds without a heartbeat before a worker is removed
+snapshot_path = '' # file the registry is snapshotted to (relative to the config file), empty to disable
+snapshot_interval = 30 # seconds between registry snapshots
+snapshot_max_age = 300 # seconds since last contact after which a snapshotted worker is not restored
+
 # Worker class - holds details for a pyPatrol-node worker
 class Worker():
     def __init__(self, data):
@@ -31,21 +42,243 @@ class Worker():
         self.ipv6_capable = data['ipv6']
         self.use_ssl = data['ssl']
         self.last_contact = datetime.now()
+        self.region = data.get('region') # optional, used for region diversity
+        self.address = str(self.node_ip) + ":" + str(self.node_port)
+        self.latency = None # EWMA of response time in seconds, None until known
+        self.error_rate = 0.0 # EWMA of failed requests (0.0 - 1.0)
+        self.leases = collections.deque() # expiry (monotonic) of every check counted in the worker's
+                                          #   load and not yet reported back, oldest first
+        self.expires = None # monotonic time the worker is removed unless it heartbeats again
+        self.verified = True # False for workers restored from a snapshot until re-verified
 
-# add_worker()
-#   Purpose: Add a worker to the active workers array
+    # record_result()
+    #   Purpose: Fold a service check result reported by a task into the worker's averages
+    #   Params:
+    #     - latency: seconds the worker took to answer
+    #     - error: True if the request to the worker failed
+    #   Returns: (none)
+    def record_result(self, latency, error):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += ewma_alpha * (latency - self.latency)
+        self.error_rate += ewma_alpha * ((1.0 if error else 0.0) - self.error_rate)
+        self.release()
+
+    # acquire()
+    #   Purpose: Count a check sent to the worker against its load for at most load_lease seconds,
+    #            so a check whose result or release is lost cannot inflate the load forever
+    #   Params: (none)
+    #   Returns: (none)
+    def acquire(self):
+        self.leases.append(time.monotonic() + load_lease)
+
+    # release()
+    #   Purpose: Stop counting a check against the worker's load
+    #   Params: (none)
+    #   Returns: (none)
+    def release(self):
+        if self.load() > 0:
+            self.leases.popleft()
+
+    # load()
+    #   Purpose: Service checks assigned to the worker and not yet reported back, dropping the
+    #            expired leases first
+    #   Params: (none)
+    #   Returns: integer
+    def load(self):
+        now = time.monotonic()
+        while len(self.leases) > 0 and self.leases[0] <= now:
+            self.leases.popleft()
+        return len(self.leases)
+
+    # cost()
+    #   Purpose: Expected cost of sending one more check to the worker, lower is better
+    #   Params: (none)
+    #   Returns: positive float
+    def cost(self):
+        latency = self.latency if self.latency is not None else 1.0
+        return max(latency, 0.001) * (1 + self.load()) / max(1.0 - self.error_rate, 0.05)
+
+    # weight()
+    #   Purpose: Selection weight for weighted sampling, fast and idle workers weigh more
+    #   Params: (none)
+    #   Returns: positive float
+    def weight(self):
+        return 1.0 / self.cost()
+
+# WorkerRegistry class - the active workers, indexed by name and by capability so that
+#   lookups, inserts, removals and selections never scan the whole fleet
+class WorkerRegistry():
+    def __init__(self):
+        self.by_name = {} # name -> Worker
+        self.by_address = {} # "ip:port" -> Worker, used to match reported results
+        self.index = { 'ipv4': [], 'ipv6': [] } # capability -> array of capable Workers
+        self.position = { 'ipv4': {}, 'ipv6': {} } # capability -> name -> position in index array
+        self.expiry = [] # heap of (expiry, name), superseded entries are skipped when popped
+        self.lock = threading.RLock() # lock to protect the registry
+
+    # capabilities()
+    #   Purpose: List the worker types a worker can serve
+    #   Params:
+    #     - worker: Worker object
+    #   Returns: array of 'ipv4'/'ipv6'
+    def capabilities(self, worker):
+        types = []
+        if worker.ipv4_capable: types.append('ipv4')
+        if worker.ipv6_capable: types.append('ipv6')
+        return types
+
+    # add()
+    #   Purpose: Register a worker, replacing any worker with the same name
+    #   Params:
+    #     - worker: Worker object
+    #   Returns: (none)
+    def add(self, worker):
+        with self.lock:
+            self.remove(worker.name)
+            self.by_name[worker.name] = worker
+            self.by_address[worker.address] = worker
+            for type in self.capabilities(worker):
+                self.position[type][worker.name] = len(self.index[type])
+                self.index[type].append(worker)
+
+    # remove()
+    #   Purpose: Unregister a worker by moving the last entry of each index array into its slot
+    #   Params:
+    #     - name: name of the worker
+    #   Returns: the removed Worker object, or None if it was not registered
+    def remove(self, name):
+        with self.lock:
+            worker = self.by_name.pop(name, None)
+            if worker is None:
+                return None
+            if self.by_address.get(worker.address) is worker:
+                del self.by_address[worker.address]
+            for type in self.capabilities(worker):
+                i = self.position[type].pop(name)
+                last = self.index[type].pop()
+                if last is not worker:
+                    self.index[type][i] = last
+                    self.position[type][last.name] = i
+            return worker
+
+    # touch()
+    #   Purpose: Push back the expiry of a worker after contact with it, O(log n). The entry it
+    #            supersedes stays in the heap until it reaches the top; the heap is rebuilt
+    #            from the live entries once superseded entries dominate
+    #   Params:
+    #     - worker: registered Worker object
+    #     - timeout: seconds from now until the worker expires
+    #   Returns: (none)
+    def touch(self, worker, timeout):
+        with self.lock:
+            worker.expires = time.monotonic() + timeout
+            heapq.heappush(self.expiry, (worker.expires, worker.name))
+            if len(self.expiry) > 4 * len(self.by_name) + 64:
+                self.expiry = [(w.expires, w.name) for w in self.by_name.values() if w.expires is not None]
+                heapq.heapify(self.expiry)
+
+    # expire()
+    #   Purpose: Remove the workers whose expiry has passed
+    #   Params:
+    #     - now: monotonic time
+    #   Returns: array of the removed Worker objects
+    def expire(self, now):
+        expired = []
+        with self.lock:
+            while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+                expires, name = heapq.heappop(self.expiry)
+                worker = self.by_name.get(name)
+                # skip entries superseded by a later heartbeat or belonging to a replaced worker
+                if worker is not None and worker.expires == expires:
+                    self.remove(name)
+                    expired.append(worker)
+        return expired
+
+    # next_expiry()
+    #   Purpose: Earliest pending expiry, possibly of a superseded entry
+    #   Params: (none)
+    #   Returns: monotonic time, or None if no worker is registered
+    def next_expiry(self):
+        with self.lock:
+            return self.expiry[0][0] if len(self.expiry) > 0 else None
+
+    # get()
+    #   Purpose: Look up a worker by name
+    #   Params:
+    #     - name: name of the worker
+    #   Returns: Worker object, or None if it is not registered
+    def get(self, name):
+        return self.by_name.get(name)
+
+    # all()
+    #   Purpose: Snapshot of every registered worker
+    #   Params: (none)
+    #   Returns: array of Worker objects
+    def all(self):
+        with self.lock:
+            return list(self.by_name.values())
+
+    # count()
+    #   Purpose: Number of registered workers able to serve a worker type
+    #   Params:
+    #     - type: 'ipv4' or 'ipv6'
+    #   Returns: integer
+    def count(self, type):
+        return len(self.index.get(type, []))
+
+    # sample()
+    #   Purpose: Select k distinct workers of a type. Uniform selection is a partial
+    #            Fisher-Yates shuffle over the capability index (O(k), no rejection); weighted
+    #            selection draws by Worker.weight() using exponential keys
+    #   Params:
+    #     - type: 'ipv4' or 'ipv6'
+    #     - k: number of workers wanted
+    #     - weighted: True to prefer fast, lightly loaded workers
+    #   Returns: array of k Worker objects, or None if fewer than k capable workers exist
+    def sample(self, type, k, weighted=False):
+        with self.lock:
+            candidates = self.index.get(type)
+            if candidates is None or len(candidates) < k:
+                return None
+            if weighted:
+                return heapq.nlargest(k, candidates, key=lambda w: random.random() ** (1.0 / w.weight()))
+            n = len(candidates)
+            swapped = {} # positions displaced by the virtual shuffle
+            chosen = []
+            for i in range(k):
+                j = random.randrange(i, n)
+                chosen.append(candidates[swapped.get(j, j)])
+                swapped[j] = swapped.get(i, i)
+            return chosen
+
+# active workers that have registered with the server
+registry = WorkerRegistry()
+pending_workers = set() # names of new workers whose verification is in progress
+
+decoder = json.JSONDecoder() # incremental decoder for heartbeat framing
+
+# keys every heartbeat must carry
+HEARTBEAT_KEYS = ('name', 'ip', 'port', 'ipv4', 'ipv6', 'ssl')
+
+workers_metric = metrics.Gauge('pypatrol_workers', 'Registered pyPatrol-node workers by type', ('type',),
+    function=lambda: { ('ipv4',): registry.count('ipv4'), ('ipv6',): registry.count('ipv6') })
+worker_latency_ewma_metric = metrics.Gauge('pypatrol_worker_latency_ewma_seconds', 'Smoothed request latency per worker, as used for load balancing', ('worker',),
+    function=lambda: dict(((w.address,), w.latency) for w in registry.all() if w.latency is not None))
+worker_error_rate_metric = metrics.Gauge('pypatrol_worker_error_rate', 'Smoothed request error rate per worker, as used for load balancing', ('worker',),
+    function=lambda: dict(((w.address,), w.error_rate) for w in registry.all()))
+unverified_metric = metrics.Gauge('pypatrol_workers_unverified', 'Workers restored from a snapshot and not re-verified yet',
+    function=lambda: sum(1 for w in registry.all() if not w.verified))
+expired_metric = metrics.Counter('pypatrol_workers_expired_total', 'Workers removed for missing their heartbeats')
+
+# verify_worker()
+#   Purpose: Check that a new worker's pyPatrol node service is responding properly. Runs on
+#            the reactor's thread pool so a slow node never blocks the Twisted endpoint
 #   Params:
 #     - data: json formatted data with details required for a pyPatrol-node worker
-#   Returns: (none)
-def add_worker(data):
-    workers_lock.acquire() # lock the active workers array from modifications
-    # first check if the worker is already in the array
-    for w in workers:
-        if w.name == data['name']:
-            # if the worker is already registered, update the last_contact time
-            w.last_contact = datetime.now()
-            workers_lock.release()
-            return
+#   Returns: True if the node reports itself as online
+def verify_worker(data):
     headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
     worker_uri = "http://" + str(data['ip']) + ":" + str(data['port']) + "/status"
     try:
@@ -53,146 +286,405 @@ def add_worker(data):
         r = requests.get(worker_uri, headers=headers, timeout=5)
         response = json.loads(r.text)
         if (response['status'] == "online"):
-            # create a new Worker object and load in data
+            return True
+        print("worker_mgr.py: add_worker - worker " + data['name'] + " status not 'online', rejecting worker.")
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print("worker_mgr.py: add_worker - Error contacting node " + data['name'] + ", rejecting as worker.")
+    return False
+
+# register_worker()
+#   Purpose: Deferred callback adding a verified worker to the active workers registry, or
+#            removing a worker restored from a snapshot that failed its re-verification
+#   Params:
+#     - online: result of verify_worker()
+#     - data: json formatted data with details required for a pyPatrol-node worker
+#   Returns: (none)
+def register_worker(online, data):
+    with registry.lock:
+        pending_workers.discard(data['name'])
+        if online:
+            # create a new Worker object and add it to the active workers registry
             worker = Worker(data)
-            # add the worker to the active workers array
-            workers.append(worker)
+            previous = registry.get(worker.name)
+            if previous is not None:
+                # re-verified worker, keep its load balancing figures
+                worker.latency = previous.latency
+                worker.error_rate = previous.error_rate
+                worker.leases = previous.leases
+            registry.add(worker)
+            registry.touch(worker, inactivity_timeout)
             print("worker_mgr.py: add_worker - added worker: " + str(worker.name))
-        else:
-            print("worker_mgr.py: add_worker - worker " + data['name'] + " status not 'online', rejecting worker.")
-    except requests.exceptions.RequestException as e:
-        print("worker_mgr.py: add_worker - Error contacting node " + data['name'] + ", rejecting as worker.")
-    workers_lock.release() # release lock on active workers array
+        elif registry.remove(data['name']) is not None:
+            print("worker_mgr.py: add_worker - removed worker failing re-verification: " + data['name'])
+
+# verification_failed()
+#   Purpose: Deferred errback for an unexpected error while verifying a worker
+#   Params:
+#     - failure: Twisted Failure
+#     - data: json formatted data with details required for a pyPatrol-node worker
+#   Returns: (none)
+def verification_failed(failure, data):
+    with registry.lock:
+        pending_workers.discard(data['name'])
+    print("worker_mgr.py: add_worker - error verifying worker " + data['name'] + ": " + str(failure.value))
+
+# add_worker()
+#   Purpose: Handle a worker heartbeat: refresh a registered worker's last contact time, or
+#            start verifying a new worker in the background and add it once it checks out.
+#            Workers restored from a snapshot keep receiving checks and are re-verified on
+#            their first heartbeat. The registry lock is only held for the lookup/mutation,
+#            never during HTTP
+#   Params:
+#     - data: json formatted data with details required for a pyPatrol-node worker
+#   Returns: (none)
+def add_worker(data):
+    with registry.lock:
+        # first check if the worker is already registered
+        w = registry.get(data['name'])
+        if w is not None:
+            # if the worker is already registered, update the last_contact time
+            w.last_contact = datetime.now()
+            registry.touch(w, inactivity_timeout)
+            if w.verified:
+                return
+        # only one verification per worker at a time
+        if data['name'] in pending_workers:
+            return
+        pending_workers.add(data['name'])
+    d = threads.deferToThread(verify_worker, data)
+    d.addCallbacks(register_worker, verification_failed, callbackArgs=(data,), errbackArgs=(data,))
 
 # check_workers()
-#   Purpose: Periodically poll the active workers array and purge any workers that haven't been
-#            contacted within the past x seconds, in effect removing not responding/inactive
-#            workers
+#   Purpose: Remove workers that haven't been contacted within the inactivity timeout, in
+#            effect removing not responding/inactive workers. Sleeps until the earliest expiry
+#            in the registry's expiry heap rather than scanning every worker
 #   Params: (none)
 #   Returns: (none)
 def check_workers():
     print("Started check_workers thread...")
-    inactivity_interval = int(config['workers']['inactivity_interval'])
     while (True):
-        for w in workers:
-            if ((datetime.now() - w.last_contact).seconds > (inactivity_interval * 1.5)):
-                print("worker_mgr.py: check_workers - removing worker due to inactivity: " + str(w.name))
-                workers_lock.acquire()
-                workers.remove(w)
-                workers_lock.release()
-        time.sleep(inactivity_interval)
+        now = time.monotonic()
+        for w in registry.expire(now):
+            print("worker_mgr.py: check_workers - removing worker due to inactivity: " + str(w.name))
+            expired_metric.inc()
+        # new workers expire a full timeout from now, so a poll every inactivity_interval (two
+        # thirds of the timeout) never sleeps past an expiry
+        next_expiry = registry.next_expiry()
+        wait = inactivity_timeout / 1.5
+        if next_expiry is not None:
+            wait = min(max(next_expiry - now, 0.01), wait)
+        time.sleep(wait)
+
+# save_snapshot()
+#   Purpose: Write the registry to snapshot_path, replacing the previous snapshot atomically
+#   Params: (none)
+#   Returns: (none)
+def save_snapshot():
+    with registry.lock:
+        workers = [{
+            'name': w.name, 'ip': w.node_ip, 'port': w.node_port, 'ipv4': w.ipv4_capable,
+            'ipv6': w.ipv6_capable, 'ssl': w.use_ssl, 'region': w.region,
+            'last_contact': w.last_contact.isoformat(), 'latency': w.latency, 'error_rate': w.error_rate
+        } for w in registry.by_name.values()]
+    tmp_path = snapshot_path + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({ 'saved_at': datetime.now().isoformat(), 'workers': workers }, f)
+        os.replace(tmp_path, snapshot_path)
+    except (OSError, TypeError, ValueError) as e:
+        print("worker_mgr.py: save_snapshot - error writing " + snapshot_path + ": " + str(e))
+
+# load_snapshot()
+#   Purpose: Restore the workers of the last snapshot contacted within snapshot_max_age seconds.
+#            Restored workers are dispatched to immediately, expire like any other worker if
+#            they do not heartbeat, and are re-verified on their first heartbeat
+#   Params: (none)
+#   Returns: (none)
+def load_snapshot():
+    if snapshot_path == '':
+        return
+    try:
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print("worker_mgr.py: load_snapshot - error reading " + snapshot_path + ": " + str(e))
+        return
+    now = datetime.now()
+    restored = 0
+    for data in snapshot.get('workers', []):
+        try:
+            last_contact = datetime.fromisoformat(data['last_contact'])
+            if (now - last_contact).total_seconds() > snapshot_max_age:
+                continue
+            worker = Worker(data)
+            worker.latency = data.get('latency')
+            worker.error_rate = float(data.get('error_rate') or 0.0)
+        except (KeyError, TypeError, ValueError):
+            continue
+        worker.last_contact = last_contact
+        worker.verified = False
+        with registry.lock:
+            if registry.get(worker.name) is None:
+                registry.add(worker)
+                registry.touch(worker, inactivity_timeout)
+                restored += 1
+    print("worker_mgr.py: load_snapshot - restored " + str(restored) + " workers pending re-verification")
+
+# snapshot_workers()
+#   Purpose: Periodically snapshot the registry so a restarted server can warm start. Always
+#            running so that snapshots enabled by a config reload take effect
+#   Params: (none)
+#   Returns: (none)
+def snapshot_workers():
+    print("Started snapshot_workers thread...")
+    while (True):
+        time.sleep(snapshot_interval)
+        if snapshot_path != '':
+            save_snapshot()
 
 # WorkerQueue class - the Twisted endpoint for pyPatrol-node workers to send their heartbeats
+#   Heartbeats are JSON documents; TCP may split one document (or one UTF-8 character) across
+#   reads or deliver several in one read, so bytes go through an incremental UTF-8 decoder and
+#   complete documents are decoded as they arrive
 class WorkerQueue(Protocol):
+    MAX_BUFFER = 65536 # drop connections that send more than this without a complete document
+
+    def connectionMade(self):
+        self.buffer = ""
+        self.utf8 = codecs.getincrementaldecoder('utf-8')('replace')
+
     def dataReceived(self, data):
-        data = json.loads(data)
+        self.buffer += self.utf8.decode(data)
+        while (True):
+            self.buffer = self.buffer.lstrip()
+            if len(self.buffer) == 0:
+                return
+            try:
+                message, end = decoder.raw_decode(self.buffer)
+            except ValueError:
+                # incomplete document, wait for more data
+                if len(self.buffer) > self.MAX_BUFFER:
+                    print("worker_mgr.py: WorkerQueue - oversized or malformed heartbeat, dropping connection")
+                    self.transport.loseConnection()
+                return
+            self.buffer = self.buffer[end:]
+            self.heartbeatReceived(message)
+
+    def heartbeatReceived(self, data):
         # ensure the worker is authorized to accept work (presents a secret key)
-        if data['secret'] in secrets:
+        if isinstance(data, dict) and data.get('secret') in secrets:
+            missing = [key for key in HEARTBEAT_KEYS if key not in data]
+            if len(missing) > 0:
+                print("worker_mgr.py: WorkerQueue - dropping heartbeat missing " + ", ".join(missing))
+                return
             add_worker(data)
         else:
-            print("Rejected unauthorized worker: " + data['name'])
+            print("Rejected unauthorized worker: " + str(data.get('name') if isinstance(data, dict) else data))
+
+# diversify()
+#   Purpose: Reorder candidate workers so that workers from regions not yet chosen come first,
+#            keeping the candidates' relative order otherwise
+#   Params:
+#     - candidates: array of Worker objects in order of preference
+#   Returns: array of Worker objects
+def diversify(candidates):
+    first = []
+    rest = []
+    regions = set()
+    for w in candidates:
+        if w.region is None or w.region not in regions:
+            regions.add(w.region)
+            first.append(w)
+        else:
+            rest.append(w)
+    return first + rest
+
+# select_workers()
+#   Purpose: Select k distinct workers of a specific type using the configured strategy
+#   Params:
+#     - type: 'ipv4' or 'ipv6' denotes the type of service check required
+#     - k: number of workers wanted
+#   Returns: array of k Worker objects, or None if fewer than k capable workers are registered
+def select_workers(type, k):
+    if selection == 'weighted':
+        candidates = registry.sample(type, registry.count(type) if region_diversity else k, True)
+    elif selection == 'p2c':
+        # power of two choices: sample twice as many workers as needed, keep the cheapest
+        if registry.count(type) < k:
+            return None
+        candidates = registry.sample(type, min(2 * k, registry.count(type)))
+        candidates.sort(key=lambda w: w.cost())
+    elif selection == 'least_loaded':
+        if registry.count(type) < k:
+            return None
+        with registry.lock:
+            candidates = sorted(registry.index[type], key=lambda w: w.cost())
+    else:
+        candidates = registry.sample(type, registry.count(type) if region_diversity else k)
+    if candidates is None or len(candidates) < k:
+        return None
+    if region_diversity:
+        candidates = diversify(candidates)
+    return candidates[:k]
 
 # get_worker()
 #   Purpose: Return one randomly selected worker of a specific type (ipv4 or ipv6) from the
-#            pypatrol node workers queue
+#            pypatrol node workers registry
 #   Params:
 #     - type: 'ipv4' or 'ipv6' denotes the type of service check required
-#   Returns: A Worker object
+#   Returns: A Worker object, or None if no capable worker is registered
 def get_worker(type):
-    # exit if no workers are registered with the server
-    if (len(workers) == 0):
-        return None
-    # get worker of requested type (ipv4 or ipv6)
-    while (True):
-        rand_int = random.randint(0, len(workers) - 1)
-        if (type == 'ipv4' and workers[rand_int].ipv4_capable):
-            return workers[rand_int]
-        elif (type == 'ipv6' and workers[rand_int].ipv6_capable):
-            return workers[rand_int]
-        # unknown service type requested, return null
-        else:
-            return None
+    workers = select_workers(type, 1)
+    return workers[0] if workers is not None else None
 
 # get_3_workers()
-#   Purpose: Returns three randomly selected workers of a specific type (ipv4 or ipv6)
-#            by repeatedly calling get_worker() until three unique workers are returned
+#   Purpose: Returns three distinct workers of a specific type (ipv4 or ipv6)
 #   Params:
 #     - type: 'ipv4' or 'ipv6' denotes the type of service check required
-#   Returns: Three Worker objects in an array
+#   Returns: Three Worker objects in an array, or None if fewer than three capable workers
+#            are registered
 def get_3_workers(type):
-    # requires at least three workers to be registered with the server
-    if (len(workers) < 3):
+    return select_workers(type, 3)
+
+# get_worker_uris()
+#   Purpose: Select workers of a specific type, count the check against the load of the k
+#            workers it is sent to and format their URIs. Spares only get a request when a
+#            check is hedged, which the task reports back as a 'sent' event
+#   Params:
+#     - type: 'ipv4' or 'ipv6' denotes the type of service check required
+#     - k: number of workers wanted, three by default
+#     - spares: extra workers to add for hedged requests, when enough are registered
+#   Returns: k (up to k + spares) Worker uri's in an array, or None if not enough workers
+#            are registered
+def get_worker_uris(type, k=3, spares=0):
+    # get the workers based on the service check type requested
+    workers = select_workers(type, max(min(k + spares, registry.count(type)), k))
+    if (workers is None):
         return None
-    three_workers = []
-    current_worker = None
-    # continue looping until three unique workers are obtained
-    while (True):
-        if (len(three_workers) == 3):
-            return three_workers
-        current_worker = get_worker(type)
-        duplicate = False
-        # make sure the returned worker is not already in the array before continuing
-        for w in three_workers:
-            if w.name == current_worker.name:
-                # worker is a duplicate, do not add worker to the array
-                duplicate = True
-                break
-        # worker is not duplicate, add to the array
-        if (not duplicate):
-            three_workers.append(current_worker)
+    results = [None] * len(workers) # initialize the return array
+    # fill array with the workers' uri
+    for i in range(len(workers)):
+        if i < k:
+            workers[i].acquire()
+        worker_uri = "http://" + workers[i].address
+        results[i] = worker_uri
+    return results
+
+# record_feedback()
+#   Purpose: Apply service check results reported by the task manager to the workers'
+#            load, latency and error averages
+#   Params:
+#     - feedback: array of {'worker': "ip:port", 'latency': seconds, 'error': bool}, or of
+#                 {'worker': "ip:port", 'event': 'sent'} for a request sent to a spare worker
+#                 and {'worker': "ip:port", 'event': 'released'} for a request that was
+#                 cancelled or never sent
+#   Returns: (none)
+def record_feedback(feedback):
+    with registry.lock:
+        for f in feedback:
+            worker = registry.by_address.get(f['worker'])
+            if worker is None:
+                continue
+            event = f.get('event', 'result')
+            if event == 'sent':
+                worker.acquire()
+            elif event == 'released':
+                worker.release()
+            else:
+                worker.record_result(f['latency'], f['error'])
 
 # worker_dispatcher()
 #   Purpose: A ZeroMQ listener that receives requests from tasks to find three workers
-#            capable of handling the service request
+#            capable of handling the service request. Accepts single requests
+#            ({'request': type}) from REQ sockets and batch requests
+#            ({'id': n, 'batch': [type, ...], 'fanout': [k, ...]}) from long-lived DEALER
+#            sockets, 'fanout' giving the number of workers per entry (three if absent) and
+#            'spares' the extra workers per entry for hedged requests. Worker results
+#            reported as {'feedback': [...]} are applied to the registry and not answered
 #   Params: (none)
-#   Returns: Three Worker uri's in an array via ZeroMQ
+#   Returns: Three Worker uri's in an array (single request) or
+#            {'id': n, 'batch': [[uri, uri, uri] or None, ...]} (batch request) via ZeroMQ
 def worker_dispatcher():
     print("Started worker_dispatcher thread...")
-    # ZeroMQ "reply" (REP) socket listening on port 6668 of localhost
+    # ZeroMQ ROUTER socket so multiple long-lived clients can pipeline requests
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER)
     dispatcher_host = config['workers']['dispatcher_host']
     dispatcher_port = config['workers']['dispatcher_port']
     socket.bind("tcp://" + dispatcher_host + ":" + dispatcher_port)
 
     # continuously listen for requests over zmq
     while (True):
-        message = socket.recv_json()
-        # get three workers based on the service check type requested
-        workers = get_3_workers(message['request'])
-        if (workers is not None):
-            results = [None] * 3 # initialize the return array
-            # fill array with three workers' uri
-            for i in range(len(workers)):
-                worker_uri = "http://" + str(workers[i].node_ip) + ":" + str(workers[i].node_port)
-                results[i] = worker_uri
+        # REQ and DEALER clients both frame requests as [identity, empty delimiter, payload]
+        frames = socket.recv_multipart()
+        identity = frames[0]
+        message = json.loads(frames[-1])
+        if 'feedback' in message:
+            record_feedback(message['feedback'])
+            continue
+        if 'batch' in message:
+            # answer every allocation in the batch with a single reply
+            results = {
+                'id': message.get('id'),
+                'batch': [get_worker_uris(type, k, message.get('spares', 0)) for type, k in
+                    zip(message['batch'], message.get('fanout', [3] * len(message['batch'])))]
+            }
         else:
-            results = None
+            results = get_worker_uris(message['request'])
         # send serialized json back over the zmq socket
-        socket.send_json(results)
+        socket.send_multipart([identity, b'', json.dumps(results).encode('utf-8')])
+
+# load_config()
+#   Purpose: Populate the worker manager settings from the pypatrol config, at startup and
+#            whenever the config is reloaded (SIGHUP)
+#   Params:
+#     - new_config: ConfigParser holding the pypatrol config
+#   Returns: (none)
+def load_config(new_config):
+    global config, secrets, selection, region_diversity, ewma_alpha, load_lease
+    global inactivity_timeout, snapshot_path, snapshot_interval, snapshot_max_age
+    config = new_config
+    secrets = json.loads(config['workers']['secrets'])
+    selection = config['workers'].get('selection', 'uniform')
+    region_diversity = config['workers'].getboolean('region_diversity', False)
+    ewma_alpha = float(config['workers'].get('ewma_alpha', '0.2'))
+    load_lease = float(config['workers'].get('load_lease', '60'))
+    inactivity_timeout = int(config['workers']['inactivity_interval']) * 1.5
+    snapshot_path = config['workers'].get('snapshot_path', '')
+    if snapshot_path != '':
+        # relative paths are kept next to the config file rather than the working directory
+        snapshot_path = os.path.join(os.path.dirname(os.path.abspath(settings.path)), snapshot_path)
+    snapshot_interval = int(config['workers'].get('snapshot_interval', '30'))
+    snapshot_max_age = int(config['workers'].get('snapshot_max_age', '300'))
 
 # main()
-#   Purpose: Initialize the worker manager component and kick off the worker inactivity
-#            thread, the worker dispatcher thread, and the Twisted factory endpoint
+#   Purpose: Initialize the worker manager component, restore the last registry snapshot and
+#            kick off the worker inactivity thread, the snapshot thread, the worker dispatcher
+#            thread, and the Twisted factory endpoint
 #   Params: (none)
 #   Returns: (none)
 def main():
     print("Started worker_mgr.py...")
 
     # read pypatrol config
-    global config
-    config = configparser.ConfigParser()
-    config.read('pypatrol.conf')
-
-    global secrets
-    secrets = json.loads(config['workers']['secrets'])
+    load_config(settings.load())
+    settings.on_reload(load_config)
+    settings.install_sighup_handler()
     random.seed() # seed random to increase entropy
+    load_snapshot()
 
     # Start Worker Inactivity check thread
     t = threading.Thread(target=check_workers, name='check_workers')
     t.setDaemon(True)
     t.start()
 
+    # Start Worker registry snapshot thread
+    s = threading.Thread(target=snapshot_workers, name='snapshot_workers')
+    s.setDaemon(True)
+    s.start()
+
     # Start Worker Dispatcher thread
     d = threading.Thread(target=worker_dispatcher, name='worker_dispatcher')
     d.setDaemon(True)
@@ -202,7 +694,11 @@ def main():
     f = Factory()
     f.protocol = WorkerQueue
     endpoint_port = int(config['workers']['endpoint_port'])
+    # new worker verification runs on the reactor thread pool
+    reactor.suggestThreadPoolSize(int(config['workers'].get('verify_threads', '10')))
     reactor.listenTCP(endpoint_port, f)
+    # /metrics for this process (every component in thread mode)
+    metrics.init(config)
     reactor.run(installSignalHandlers=0)
 
 if __name__ == '__main__':